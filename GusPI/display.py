@@ -0,0 +1,14 @@
+import os
+
+# Headless mode skips every plot, so compute-only workers never import matplotlib, seaborn or plotly.
+# It can also be switched on with the GUSPI_HEADLESS=1 environment variable.
+_HEADLESS = os.environ.get('GUSPI_HEADLESS', '0') not in ('', '0')
+
+
+def set_headless(headless=True):
+    global _HEADLESS
+    _HEADLESS = headless
+
+
+def is_headless():
+    return _HEADLESS
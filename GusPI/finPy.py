@@ -1,81 +1,309 @@
+import ast
+import collections
+import os
+import re
+import tempfile
+import warnings
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
+import numpy as np
 import math
-import plotly.graph_objects as go
 import json
-import simfin as sf
-from simfin.names import *
+from GusPI import display, instrument
+
+# simfin, matplotlib, seaborn and plotly are imported by the functions that use them,
+# so compute-only use of this module starts fast
 
 
 def prep_dataframe(file):
     pd.set_option('display.float_format', lambda x: '%.2f' % x)
-    statement = pd.read_csv(file)
-    statement.iloc[:, 0] = statement.iloc[:, 0].str.replace(' ', '_')
-    statement.iloc[:, 0] = statement.iloc[:, 0].str.replace(',', '')
-    statement.iloc[:, 0] = statement.iloc[:, 0].str.replace('&', '')
-    statement.iloc[:, 0] = statement.iloc[:, 0].str.lower()
-    statement = statement.set_index(statement.columns[0])
-    statement = statement.abs()
+    return _read_statement(file)
+
+
+# Line item names: lower case, spaces to underscores, commas and ampersands removed
+_NAME_TABLE = str.maketrans({' ': '_', ',': None, '&': None})
+
+
+def _normalize_names(names):
+    # Each distinct name is normalized once, however often it appears
+    codes, uniques = pd.factorize(pd.Index(names))
+    uniques = pd.Index(uniques).str.lower().str.translate(_NAME_TABLE)
+    return pd.Index(uniques.take(codes, allow_fill=True), name=getattr(names, 'name', None))
+
+
+def _read_statement(file, normalize=True):
+    # A statement csv with its line items as the index; no pandas options are changed
+    with instrument.span('finPy.parse') as span:
+        statement = pd.read_csv(file)
+        statement = statement.set_index(statement.columns[0])
+        if normalize:
+            statement.index = _normalize_names(statement.index)
+        statement = statement.abs()
+        span.set(rows=len(statement))
     return statement
 
 
+_STATEMENT_NAME = re.compile(r'income|balance|cash[-_ ]?flow', re.IGNORECASE)
+
+
+def _statement_file_name(path):
+    # (company, statement) from a file name such as AAPL_income_statement.csv or AAPL/balancesheet.csv:
+    # the statement is income, balancesheet or cashflow, the company is what comes before it in the
+    # file name, or the name of the folder when nothing does
+    stem = os.path.splitext(os.path.basename(path))[0]
+    match = _STATEMENT_NAME.search(stem)
+    if match is None:
+        return None
+    statement = {'income': 'income', 'balance': 'balancesheet'}.get(match.group(0).lower(), 'cashflow')
+    company = stem[:match.start()].strip('_-. ') or os.path.basename(os.path.dirname(os.path.abspath(path)))
+    return company, statement
+
+
+def load_statements(source, workers=None, executor='thread', name_parser=None):
+    # Statement csv files of many companies in one frame indexed by company, statement and line_item,
+    # with the periods as columns in time order. source: a directory (every csv below it), a glob
+    # pattern or a list of files. Files are read in a thread or process pool (executor='process') and
+    # line item names are normalized once for all files, as prep_dataframe does for one.
+    # name_parser(path) -> (company, statement) replaces the file name convention of _statement_file_name;
+    # files it returns None for are skipped.
+    # Periods a company does not report are empty columns of its slice:
+    # panel.loc[('AAPL', 'balancesheet')].dropna(axis=1, how='all') is the statement as calculateMetrics
+    # expects it.
+    import glob
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    if executor not in ('thread', 'process'):
+        raise ValueError("executor must be 'thread' or 'process'")
+    if isinstance(source, (list, tuple)):
+        files = list(source)
+    elif os.path.isdir(os.path.expanduser(source)):
+        files = sorted(glob.glob(os.path.join(os.path.expanduser(source), '**', '*.csv'), recursive=True))
+    else:
+        files = sorted(glob.glob(os.path.expanduser(source), recursive=True))
+    name_parser = name_parser or _statement_file_name
+    keys, paths, skipped = [], [], []
+    for path in files:
+        key = name_parser(path)
+        if key is None:
+            skipped.append(os.path.basename(path))
+        else:
+            keys.append(tuple(key))
+            paths.append(path)
+    if skipped:
+        warnings.warn('Not a statement file: ' + ', '.join(skipped))
+    if not paths:
+        raise ValueError('No statement files found in %s' % (source,))
+    duplicates = sorted(key for key, n in collections.Counter(keys).items() if n > 1)
+    if duplicates:
+        raise ValueError('More than one file for: ' + ', '.join('%s %s' % key for key in duplicates))
+
+    pool = ThreadPoolExecutor if executor == 'thread' else ProcessPoolExecutor
+    with instrument.span('finPy.bulk_load', files=len(paths), executor=executor) as span:
+        with pool(max_workers=workers) as executor_pool:
+            statements = list(executor_pool.map(_read_statement, paths, [False] * len(paths)))
+        panel = pd.concat(statements, keys=keys, sort=False)
+        panel.index = pd.MultiIndex.from_arrays(
+            [panel.index.get_level_values(0), panel.index.get_level_values(1),
+             _normalize_names(panel.index.get_level_values(2))], names=['company', 'statement', 'line_item'])
+        panel = panel[_chronological(panel.columns)]
+        # Sorted by company and statement for fast lookups; line items keep the order of their file
+        panel = panel.sort_index(level=[0, 1], sort_remaining=False)
+        span.set(rows=len(panel))
+    return panel
+
+
 def prep_json(file):
+    # Compact JSON as written by pandas: no spaces after separators, '/' escaped as '\/' (e.g. "12\/31\/19")
+    # and floats to 10 decimal places. Parsed, it is the same as before; compare parsed values, not strings.
     statement = prep_dataframe(file)
-    statement_json = statement.to_json(orient="index")
-    parsed = json.loads(statement_json)
-    statement_json = json.dumps(parsed)
-    return statement_json
+    with instrument.span('finPy.json', rows=len(statement)):
+        return statement.to_json(orient="index")
+
+
+# Whole-market SimFin datasets loaded once per (dataset, variant, market), indexed by Ticker and Fiscal_Year.
+# Each entry holds the frame and the rows of every ticker, so a symbol lookup does not touch the rest
+# of the market. clear_market_store() drops entries so the next call loads them again.
+_MARKET_STORE = {}
+_PREPARED_MARKETS = set()
+
+# Statement categories of get_annual_finData_by_symbol and their SimFin dataset names
+SIMFIN_DATASETS = {'income': 'income', 'balancesheet': 'balance', 'cashflow': 'cashflow'}
+
+
+# Directory of pre-downloaded SimFin bulk csv files (e.g. us-income-annual.csv) that are loaded offline;
+# None loads through the simfin package. Set by use_local_data or the GUSPI_SIMFIN_DIR environment variable.
+_LOCAL_DATA_DIR = os.environ.get('GUSPI_SIMFIN_DIR')
+_LOCAL_COLUMNS = None
+
+SIMFIN_DATES = ['Report Date', 'Publish Date', 'Restated Date']
+
+
+def use_local_data(directory='~/simfin_data/', columns=None):
+    # Load SimFin datasets from the bulk csv files in directory, without the simfin package or a download.
+    # columns=None reads every column; 'ratios' reads only the line items the registered ratios use, for
+    # every caller. calculate_ratio_mass reads only those from local files either way.
+    global _LOCAL_DATA_DIR, _LOCAL_COLUMNS
+    _LOCAL_DATA_DIR = os.path.expanduser(directory) if directory is not None else None
+    _LOCAL_COLUMNS = columns
+    clear_market_store()
+
+
+def _columnar_path(csv_path):
+    # The bulk csv file is converted to an uncompressed feather file next to it, which can be memory-mapped.
+    # It is converted again when the csv file is newer.
+    feather_path = os.path.splitext(csv_path)[0] + '.feather'
+    if not os.path.exists(feather_path) or os.path.getmtime(feather_path) < os.path.getmtime(csv_path):
+        with instrument.span('finPy.columnar_convert', file=os.path.basename(csv_path)) as span:
+            header = pd.read_csv(csv_path, sep=';', nrows=0).columns
+            df = pd.read_csv(csv_path, sep=';', parse_dates=[c for c in SIMFIN_DATES if c in header])
+            # A temporary name of its own, so processes converting the same file at once do not collide
+            handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(feather_path), suffix='.tmp')
+            os.close(handle)
+            try:
+                df.to_feather(temp_path, compression='uncompressed')
+                os.replace(temp_path, feather_path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+            span.set(rows=len(df))
+    return feather_path
+
+
+def _local_path(dataset, country, variant, directory=None):
+    directory = os.path.expanduser(directory or _LOCAL_DATA_DIR or '~/simfin_data/')
+    return _columnar_path(os.path.join(directory, '%s-%s-%s.csv' % (country, dataset, variant)))
+
+
+def _local_column_names(feather_path):
+    import pyarrow as pa
+    with pa.memory_map(feather_path) as source:
+        return pa.ipc.open_file(source).schema.names
+
+
+def load_local_dataset(dataset, country='us', variant='annual', columns=None, directory=None):
+    # A SimFin bulk dataset from local files (e.g. ~/simfin_data/us-income-annual.csv), read from its
+    # columnar copy; columns selects the columns to read (Ticker and Fiscal Year are always included)
+    feather_path = _local_path(dataset, country, variant, directory)
+    import pyarrow.feather as feather
+    if columns is not None:
+        available = _local_column_names(feather_path)
+        columns = [c for c in dict.fromkeys(['Ticker', 'Fiscal Year'] + list(columns)) if c in available]
+    with instrument.span('finPy.local_load', dataset=dataset, market=country) as span:
+        df = feather.read_table(feather_path, columns=columns, memory_map=True).to_pandas()
+        span.set(rows=len(df), columns=df.shape[1])
+    return df
 
 
 # period = annual, quarterly
 # country= us
 def prepare_finData(country):
-    sf.set_api_key('free')
-    sf.set_data_dir('~/simfin_data/')
-    sf.load_companies(market=country)
-    sf.load_industries()
+    # Companies and industries are loaded once per market
+    if country in _PREPARED_MARKETS:
+        return
+    import simfin as sf
+    with instrument.span('finPy.simfin_load', dataset='companies', market=country):
+        sf.set_api_key('free')
+        sf.set_data_dir('~/simfin_data/')
+        sf.load_companies(market=country)
+        sf.load_industries()
+    _PREPARED_MARKETS.add(country)
+
+
+def ratio_columns(dataset, country='us', variant='annual'):
+    # SimFin columns of a local dataset that the registered ratios (RATIOS, RATIO_INTERMEDIATES and
+    # register_ratio) read, matched the way evaluate_ratios matches line items to columns
+    line_items = {reference.translate(_NAME_TABLE) for _, _, references in _ratio_plan()
+                  for reference in references if reference not in RATIOS and reference not in RATIO_INTERMEDIATES}
+    names = _local_column_names(_local_path(dataset, country, variant))
+    return [name for name in names if name.lower().translate(_NAME_TABLE) in line_items]
+
+
+def _local_columns(dataset, country, variant, columns=None):
+    # Columns to read from a local file: those asked for, else the use_local_data setting; None for all.
+    # 'ratios' stands for ratio_columns, so the projection follows the ratio registry.
+    if columns is None:
+        columns = _LOCAL_COLUMNS
+    if isinstance(columns, str) and columns == 'ratios':
+        columns = ratio_columns(dataset, country, variant)
+    return tuple(columns) if columns is not None else None
+
+
+def _load_simfin(dataset, variant, country, columns=None):
+    if _LOCAL_DATA_DIR is not None:
+        return load_local_dataset(dataset, country, variant, columns)
+    import simfin as sf
+    prepare_finData(country)
+    load = {'income': sf.load_income, 'balance': sf.load_balance, 'cashflow': sf.load_cashflow}[dataset]
+    with instrument.span('finPy.simfin_load', dataset=dataset, market=country) as span:
+        df = load(variant=variant, market=country)
+        span.set(rows=len(df))
+    return df
+
+
+def _market_data(dataset, country, variant='annual', columns=None):
+    # columns narrows what is read from local files and is part of the store key, so a projected
+    # dataset is never served to a caller that wants every column. A stored full dataset serves any
+    # projection, and the simfin package always loads every column.
+    columns = _local_columns(dataset, country, variant, columns) if _LOCAL_DATA_DIR is not None else None
+    key = (dataset, variant, country, columns)
+    if columns is not None and (dataset, variant, country, None) in _MARKET_STORE:
+        key = (dataset, variant, country, None)
+    if key in _MARKET_STORE:
+        instrument.count('finPy.store_hit', dataset=dataset, market=country)
+        return _MARKET_STORE[key]
+    instrument.count('finPy.store_miss', dataset=dataset, market=country)
+    df = _load_simfin(dataset, variant, country, columns)
+    if isinstance(df.index, pd.MultiIndex):
+        df = df.reset_index()
+    df.columns = df.columns.str.replace(' ', '_')
+    df = df.set_index(['Ticker', 'Fiscal_Year']).sort_index()
+    rows = df.groupby(level=0, sort=False).indices
+    _MARKET_STORE[key] = (df, rows)
+    return _MARKET_STORE[key]
+
+
+def get_market_data(dataset, country, variant='annual'):
+    # dataset = income, balance, cashflow
+    # The stored frame is shared between calls; copy it before changing it
+    return _market_data(dataset, country, variant)[0]
+
+
+def clear_market_store(dataset=None, variant=None, country=None):
+    # Drop the stored datasets that match every argument given (all of them by default), whatever
+    # columns they were read with
+    for key in list(_MARKET_STORE):
+        if all(value is None or value == part for value, part in zip((dataset, variant, country), key)):
+            del _MARKET_STORE[key]
+    if dataset is None and variant is None:
+        _PREPARED_MARKETS.difference_update([country] if country is not None else list(_PREPARED_MARKETS))
 
 
 def get_annual_finData_income(country):
-    prepare_finData(country)
-    df_income = sf.load_income(variant='annual', market=country)
-    df_income.columns = df_income.columns.str.replace(' ', '_')
-    return df_income
+    return get_market_data('income', country).copy()
 
 
 def get_annual_finData_balance(country):
-    prepare_finData(country)
-    df_balance = sf.load_balance(variant='annual', market=country)
-    df_balance.columns = df_balance.columns.str.replace(' ', '_')
-    return df_balance
+    return get_market_data('balance', country).copy()
 
 
 def get_annual_finData_cashflow(country):
-    prepare_finData(country)
-    df_cashflow = sf.load_cashflow(variant='annual', market=country)
-    df_cashflow.columns = df_cashflow.columns.str.replace(' ', '_')
-    return df_cashflow
+    return get_market_data('cashflow', country).copy()
 
 
 def get_annual_finData_by_symbol(category, symbol, country):
-    try:
-        if category == "income":
-            df = get_annual_finData_income(country)
-        if category == "balancesheet":
-            df = get_annual_finData_balance(country)
-        if category == "cashflow":
-            df = get_annual_finData_cashflow(country)
-        df.columns = df.columns.str.lower()
-        df = df.loc[symbol].transpose()
-        df = df.rename(index={'fiscal_year': 'breakdown'})
-        df.columns = df.loc['breakdown']
-        df = df.drop(['simfinid', 'currency', 'breakdown', 'fiscal_period', 'publish_date', 'restated_date'])
-        return df
-    except UnboundLocalError:
+    if category not in SIMFIN_DATASETS:
         print('Not a valid category')
-    except KeyError:
+        return
+    df, rows = _market_data(SIMFIN_DATASETS[category], country)
+    if symbol not in rows:
         print('Not a valid symbol')
+        return
+    with instrument.span('finPy.symbol_filter', dataset=category, rows=len(rows[symbol])):
+        df = df.iloc[rows[symbol]].droplevel(0)
+    df.columns = df.columns.str.lower()
+    df = df.drop(columns=['simfinid', 'currency', 'fiscal_period', 'report_date', 'publish_date',
+                          'restated_date'], errors='ignore')
+    df = df.astype(float).transpose()
+    df.columns.name = 'breakdown'
+    return df
 
 
 def printStatement(file):
@@ -84,136 +312,349 @@ def printStatement(file):
 
 
 def lineplot(dataframe, category):
-    plotData = dataframe.T
-    plotData = plotData.reset_index()
-    # plotData.columns[0]= pd.to_datetime(plotData.columns[0])
-    plotData = plotData.sort_values(plotData.columns[0])
-    plotData = plotData[[plotData.columns[0], category]]
-    plotData[category] = plotData[category].astype(float)
-
-    plt.figure(figsize=(20, 9))
-    sns.lineplot(data=plotData, x=plotData.columns[0], y=category)
+    if display.is_headless():
+        return
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    with instrument.span('finPy.plot', plot='lineplot'):
+        plotData = dataframe.T
+        plotData = plotData.reset_index()
+        # plotData.columns[0]= pd.to_datetime(plotData.columns[0])
+        plotData = plotData.sort_values(plotData.columns[0])
+        plotData = plotData[[plotData.columns[0], category]]
+        plotData[category] = plotData[category].astype(float)
+
+        plt.figure(figsize=(20, 9))
+        sns.lineplot(data=plotData, x=plotData.columns[0], y=category)
 
 
 def multiLineplot(dataframe, title):
-    plotData = dataframe.T
-    plotData = plotData.reset_index()
-    if len(str(plotData.iat[0, 0])) > 4:
-        plotData['index'] = pd.to_datetime(plotData['index'])
-    plotData = plotData.sort_values(plotData.columns[0])
-
-    columnsList = list(plotData.columns.values)
-    graphRowCount = math.ceil(len(plotData.columns) / 3)
-    fig = plt.figure(figsize=(30, 45))
-    fig.suptitle(title, fontsize=30)
-
-    for x in range(1, len(columnsList)):
-        plotNumber = 'ax' + str(x)
-        colname = plotData.columns[x]
-
-        plotNumber = fig.add_subplot(graphRowCount, 3, x)
-        plotNumber.set_title(colname)
-        plotNumber.plot(plotData.iloc[:, 1],
-                        plotData[colname])
-        plt.xticks(rotation=45)
-
-    plt.show()
+    if display.is_headless():
+        return
+    import matplotlib.pyplot as plt
+    with instrument.span('finPy.plot', plot='multiLineplot'):
+        plotData = dataframe.T
+        plotData = plotData.reset_index()
+        if len(str(plotData.iat[0, 0])) > 4:
+            plotData['index'] = pd.to_datetime(plotData['index'])
+        plotData = plotData.sort_values(plotData.columns[0])
+
+        columnsList = list(plotData.columns.values)
+        graphRowCount = math.ceil(len(plotData.columns) / 3)
+        fig = plt.figure(figsize=(30, 45))
+        fig.suptitle(title, fontsize=30)
+
+        for x in range(1, len(columnsList)):
+            plotNumber = 'ax' + str(x)
+            colname = plotData.columns[x]
+
+            plotNumber = fig.add_subplot(graphRowCount, 3, x)
+            plotNumber.set_title(colname)
+            plotNumber.plot(plotData.iloc[:, 1],
+                            plotData[colname])
+            plt.xticks(rotation=45)
+
+        plt.show()
+
+
+# Ratio definitions: each ratio is an expression over statement line items (lower case names, as in a
+# prepared statement) written in braces, other ratios or intermediates, numbers and + - * / **.
+# mean(), sum(), min() and max() aggregate a line item over the periods of each company; abs() is per period.
+# Definitions are resolved once into a dependency graph and every line item, intermediate and ratio is
+# computed once per evaluation. Add or replace definitions with register_ratio.
+RATIOS = {
+    # Liquidity Ratios
+    'acid-test_ratio': '{total_current_assets} / {total_current_liabilities}',
+    'cash_ratio': '({total_current_assets} - {inventories}) / {total_current_liabilities}',
+    # Leverage Financial Ratios
+    'debt_to_equity_ratio': '{total_liabilities} / {total_equity}',
+    'interest_coverage_ratio': '{pretax_income_(loss),_adj.} / {interest_expense,_net}',
+    'current_ratio': '{total_current_assets} / {total_current_liabilities}',
+    # Efficiency Ratios
+    'asset_to_sales_ratio': '{total_assets} / {revenue}',
+    'asset_turnover_ratio': '{revenue} / {total_assets}',
+    'inventory_turnover_ratio': '{cost_of_revenue} / {average_inventory}',
+    'days_sales_in_inventory_ratio': '365 / {inventory_turnover_ratio}',
+    'receivables_turnover_ratio': '{revenue} / {average_accounts_receivable}',
+    'average_collection_period': '365 / {receivables_turnover_ratio}',
+    # Profitability Ratios
+    'gross_margin_ratio': '{gross_profit} / {revenue}',
+    'operating_margin_ratio': '{net_income} / {revenue}',
+    'return_on_assets_ratio': '{net_income} / {revenue}',
+    'return_on_equity_ratio': '{net_income} / ({revenue} - {total_liabilities})',
+    'net_working_capital': '{total_current_assets} - {total_liabilities}',
+    'operating_margin': '{operating_income_(loss)} / {revenue}',
+    'retention_ratio': '{retained_earnings} / {revenue}',
+}
+
+# Values used by the ratios that are not returned themselves
+RATIO_INTERMEDIATES = {
+    'average_inventory': 'mean({inventories})',
+    'average_accounts_receivable': 'mean({accounts_&_notes_receivable})',
+}
+
+_RATIO_FUNCTIONS = ('mean', 'sum', 'min', 'max', 'abs')
+_RATIO_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.Name, ast.Call, ast.Load,
+                ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd)
+_RATIO_PLAN = None
+
+
+def register_ratio(name, expression, intermediate=False):
+    # e.g. register_ratio('quick_ratio', '({total_current_assets} - {inventories}) / {total_current_liabilities}')
+    global _RATIO_PLAN
+    _compile_ratio(name, expression)
+    saved = dict(RATIOS), dict(RATIO_INTERMEDIATES)
+    definitions = RATIO_INTERMEDIATES if intermediate else RATIOS
+    (RATIOS if intermediate else RATIO_INTERMEDIATES).pop(name, None)
+    definitions[name] = expression
+    _RATIO_PLAN = None
+    try:
+        _ratio_plan()
+    except ValueError:
+        # A definition that closes a cycle is not kept
+        RATIOS.clear(), RATIOS.update(saved[0])
+        RATIO_INTERMEDIATES.clear(), RATIO_INTERMEDIATES.update(saved[1])
+        _RATIO_PLAN = None
+        raise
+
+
+def _compile_ratio(name, expression):
+    # The expression with every {name} replaced by a variable, checked to use only arithmetic and
+    # the aggregate functions; returns the code and the referenced names in variable order
+    references = []
+
+    def variable(match):
+        reference = match.group(1).strip()
+        if reference not in references:
+            references.append(reference)
+        return '_%d' % references.index(reference)
+
+    source = re.sub(r'\{([^{}]+)\}', variable, expression)
+    try:
+        tree = ast.parse(source, mode='eval')
+    except SyntaxError:
+        raise ValueError('Invalid expression for %s: %s' % (name, expression))
+    for node in ast.walk(tree):
+        valid = isinstance(node, _RATIO_NODES)
+        if isinstance(node, ast.Name):
+            valid = node.id in _RATIO_FUNCTIONS or re.fullmatch(r'_\d+', node.id) is not None
+        elif isinstance(node, ast.Call):
+            valid = (isinstance(node.func, ast.Name) and node.func.id in _RATIO_FUNCTIONS
+                     and len(node.args) == 1 and not node.keywords)
+        elif isinstance(node, ast.Constant):
+            valid = isinstance(node.value, (int, float))
+        if not valid:
+            raise ValueError('Invalid expression for %s: %s' % (name, expression))
+    return compile(tree, '<ratio %s>' % name, 'eval'), references
+
+
+def _ratio_plan():
+    # Every definition compiled once, in dependency order
+    global _RATIO_PLAN
+    if _RATIO_PLAN is not None:
+        return _RATIO_PLAN
+    definitions = dict(RATIO_INTERMEDIATES, **RATIOS)
+    compiled = {name: _compile_ratio(name, expression) for name, expression in definitions.items()}
+    plan, state = [], {}
+
+    def visit(name, path):
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'visiting':
+            raise ValueError('Circular ratio definition: ' + ' -> '.join(path + [name]))
+        state[name] = 'visiting'
+        for reference in compiled[name][1]:
+            if reference in compiled:
+                visit(reference, path + [name])
+        state[name] = 'done'
+        plan.append((name, compiled[name][0], compiled[name][1]))
+
+    for name in definitions:
+        visit(name, [])
+    _RATIO_PLAN = plan
+    return plan
+
+
+def evaluate_ratios(data, ratios=None):
+    # data: line items as columns, one row per period of a company, or a Ticker/fiscal_year panel.
+    # Returns one column per ratio (all of RATIOS, or the names given). Ratios whose line items are
+    # missing from data are left empty and reported in a warning.
+    names = list(RATIOS) if ratios is None else list(ratios)
+    codes = pd.factorize(data.index.get_level_values(0))[0] if isinstance(data.index, pd.MultiIndex) \
+        else np.zeros(len(data), dtype=np.int64)
+    groups = codes.max() + 1 if len(codes) else 0
+
+    def aggregate(how):
+        def apply(values):
+            values = np.asarray(values, dtype=float)
+            if values.ndim == 0:
+                return values
+            present = ~np.isnan(values)
+            if how in ('mean', 'sum'):
+                total = np.bincount(codes, weights=np.where(present, values, 0.0), minlength=groups)
+                if how == 'mean':
+                    total = total / np.bincount(codes, weights=present, minlength=groups)
+                return total[codes]
+            result = np.full(groups, np.nan)
+            reduce = np.fmin if how == 'min' else np.fmax
+            reduce.at(result, codes[present], values[present])
+            return result[codes]
+        return apply
+
+    functions = {how: aggregate(how) for how in ('mean', 'sum', 'min', 'max')}
+    functions['abs'] = np.abs
+    values, missing = {}, {}
+    # Statements read from csv files name line items without commas and ampersands
+    columns = {}
+    if pd.api.types.is_object_dtype(data.columns) or pd.api.types.is_string_dtype(data.columns):
+        columns.update(zip(_normalize_names(data.columns), data.columns))
+    columns.update((column, column) for column in data.columns)
+    with instrument.span('finPy.ratios', rows=len(data)), np.errstate(divide='ignore', invalid='ignore'):
+        for name, code, references in _ratio_plan():
+            inputs = []
+            for reference in references:
+                source = columns.get(reference, columns.get(reference.translate(_NAME_TABLE)))
+                if reference in values:
+                    inputs.append(values[reference])
+                elif reference in missing:
+                    missing.setdefault(name, set()).update(missing[reference])
+                elif source is not None:
+                    column = data[source]
+                    if isinstance(column, pd.DataFrame):
+                        column = column.iloc[:, 0]
+                    values[reference] = pd.to_numeric(column, errors='coerce').to_numpy(dtype=float)
+                    inputs.append(values[reference])
+                elif reference not in RATIOS and reference not in RATIO_INTERMEDIATES:
+                    missing.setdefault(name, set()).add(reference)
+                else:
+                    missing.setdefault(name, set())
+            if name in missing:
+                continue
+            scope = dict(functions, __builtins__={})
+            scope.update(('_%d' % i, value) for i, value in enumerate(inputs))
+            values[name] = np.broadcast_to(np.asarray(eval(code, scope), dtype=float), len(data))
+
+    unknown = [name for name in names if name not in RATIOS and name not in RATIO_INTERMEDIATES]
+    if unknown:
+        raise ValueError('Unknown ratios: ' + ', '.join(unknown))
+    skipped = ['%s (%s)' % (name, ', '.join(sorted(missing[name]))) for name in names if name in missing]
+    if skipped:
+        warnings.warn('Ratios without the line items they need: ' + '; '.join(skipped))
+    return pd.DataFrame({name: values.get(name, np.full(len(data), np.nan)) for name in names},
+                        index=data.index)
 
 
 def calculateMetrics(balanceSheet, incomeStatement):
     frames = [balanceSheet, incomeStatement]
-    Ratio = pd.DataFrame()
     dataframeForRatio = pd.concat(frames)
     dataframeForRatio = dataframeForRatio.T
-    dataframeForRatio['average_inventory'] = dataframeForRatio['inventories'].mean()
-    dataframeForRatio['average_accounts_receivable'] = dataframeForRatio['accounts_&_notes_receivable'].mean()
-
-    # Liquidity Ratios
-    # Ratio['quick_ratio'] = (dataframeForRatio['Cash,_Cash_Equivalents_&_Short_Term_Investments']+dataframeForRatio['Accounts_&_Notes_Receivable']+dataframeForRatio['short_term_investments'])/dataframeForRatio['Total_Current_Liabilities']
-    Ratio['acid-test_ratio'] = dataframeForRatio['total_current_assets'] / dataframeForRatio[
-        'total_current_liabilities']
-    Ratio['cash_ratio'] = (dataframeForRatio['total_current_assets'] - dataframeForRatio['inventories']) / \
-                          dataframeForRatio['total_current_liabilities']
-
-    # Leverage Financial Ratios
-    Ratio['debt_to_equity_ratio'] = dataframeForRatio['total_liabilities'] / dataframeForRatio['total_equity']
-    Ratio['interest_coverage_ratio'] = dataframeForRatio['gross_profit'] / dataframeForRatio['interest_expense,_net']
-    Ratio['current_ratio'] = dataframeForRatio['total_current_assets'] / dataframeForRatio['total_current_liabilities']
-    # Ratio['debt_service_coverage_ratio'] = dataframeForRatio['gross_profit']/dataframeForRatio['']
-
-    # Efficiency Ratios
-    Ratio['asset_to_sales_ratio'] = dataframeForRatio['total_assets'] / dataframeForRatio['revenue']
-    Ratio['asset_turnover_ratio'] = dataframeForRatio['revenue'] / dataframeForRatio['total_assets']
-    Ratio['inventory_turnover_ratio'] = dataframeForRatio['cost_of_revenue'] / dataframeForRatio['average_inventory']
-    Ratio['days_sales_in_inventory_ratio'] = 365 / Ratio['inventory_turnover_ratio']
-    Ratio['receivables_turnover_ratio'] = dataframeForRatio['revenue'] / dataframeForRatio[
-        'average_accounts_receivable']
-    Ratio['average_collection_period'] = 365 / Ratio['receivables_turnover_ratio']
-    Ratio['interest_coverage_ratio'] = dataframeForRatio['pretax_income_(loss),_adj.'] / dataframeForRatio[
-        'interest_expense,_net']
-
-    # Profitability Ratios
-    Ratio['gross_margin_ratio'] = dataframeForRatio['gross_profit'] / dataframeForRatio['revenue']
-    Ratio['operating_margin_ratio'] = dataframeForRatio['net_income'] / dataframeForRatio['revenue']
-    Ratio['return_on_assets_ratio'] = dataframeForRatio['net_income'] / dataframeForRatio['revenue']
-    Ratio['return_on_equity_ratio'] = dataframeForRatio['net_income'] / (
-            dataframeForRatio['revenue'] - dataframeForRatio['total_liabilities'])
-    Ratio['net_working_capital'] = dataframeForRatio['total_current_assets'] - dataframeForRatio['total_liabilities']
-    Ratio['operating_margin'] = dataframeForRatio['operating_income_(loss)'] / dataframeForRatio['revenue']
-    Ratio['retention_ratio'] = dataframeForRatio['retained_earnings'] / dataframeForRatio['revenue']
 
+    Ratio = evaluate_ratios(dataframeForRatio)
     Ratio = Ratio.T
     Ratio = Ratio.round(4)
     return Ratio
 
 
 def bulletChart(file, item):
+    if display.is_headless():
+        return
+    import plotly.graph_objects as go
     statement = prep_dataframe(file)
 
-    data = statement.T
-    data = data.reset_index()
-    data = data.sort_values(by='index', ascending=False)
-    avg_item = 'avg_' + item
-    data[avg_item] = data[item].mean()
-    data = data.round(2)
-    data = data.iloc[0]
-
-    fig = go.Figure(go.Indicator(
-        mode="number+gauge+delta",
-        gauge={'shape': "bullet"},
-        value=data[item],
-        delta={'reference': data[avg_item]},
-        domain={'x': [0, 1], 'y': [0, 1]},
-        title={'text': item}))
-    fig.update_layout(height=250)
-
-    fig.show()
+    with instrument.span('finPy.plot', plot='bullet'):
+        data = statement.T
+        data = data.reset_index()
+        data = data.sort_values(by='index', ascending=False)
+        avg_item = 'avg_' + item
+        data[avg_item] = data[item].mean()
+        data = data.round(2)
+        data = data.iloc[0]
+
+        fig = go.Figure(go.Indicator(
+            mode="number+gauge+delta",
+            gauge={'shape': "bullet"},
+            value=data[item],
+            delta={'reference': data[avg_item]},
+            domain={'x': [0, 1], 'y': [0, 1]},
+            title={'text': item}))
+        fig.update_layout(height=250)
+
+        fig.show()
+
+
+def _chronological(columns):
+    # Periods in time order: years as numbers, '12/31/19' style labels as dates, anything else as text
+    if pd.api.types.is_numeric_dtype(columns):
+        return columns.sort_values()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        dates = pd.to_datetime(pd.Series(columns), errors='coerce')
+    if dates.isna().any():
+        return pd.Index(sorted(columns))
+    return columns[np.argsort(dates.values, kind='stable')]
+
+
+def horizontal_analysis(statement):
+    # Amount and percent change between every pair of consecutive periods.
+    # statement: line items as rows and periods as columns (prep_dataframe, get_annual_finData_by_symbol),
+    # or a Ticker/fiscal_year panel with line items or ratios as columns (calculate_ratio_mass,
+    # get_statement_panel), where periods are compared within each ticker.
+    # Returns a numeric frame in the same layout with 'amount' and 'percent' column groups, without the
+    # first period; percent is in percent (5.0 = 5%).
+    with instrument.span('finPy.analysis', analysis='horizontal', rows=len(statement)):
+        if isinstance(statement.index, pd.MultiIndex):
+            # Tickers stay in the order given, periods are sorted within each ticker
+            data = statement.select_dtypes('number')
+            tickers = pd.factorize(data.index.get_level_values(0))[0]
+            data = data.iloc[np.lexsort((data.index.get_level_values(1), tickers))]
+            tickers = np.sort(tickers)
+            previous = data.shift()
+            has_previous = np.r_[False, tickers[1:] == tickers[:-1]]
+            amount = (data - previous)[has_previous]
+            percent = ((data / previous - 1) * 100)[has_previous]
+        else:
+            data = statement[_chronological(statement.columns)].apply(pd.to_numeric, errors='coerce')
+            previous = data.shift(axis=1)
+            amount = (data - previous).iloc[:, 1:]
+            percent = ((data / previous - 1) * 100).iloc[:, 1:]
+        return pd.concat({'amount': amount, 'percent': percent}, axis=1)
+
+
+def vertical_analysis(statement, base=None):
+    # Common-size statement: every line item as a percent of the base line item of the same period
+    # (and ticker, for a panel). base defaults to total_assets when present, otherwise revenue.
+    # statement takes the same layouts as horizontal_analysis.
+    panel = isinstance(statement.index, pd.MultiIndex)
+    items = statement.columns if panel else statement.index
+    if base is None:
+        base = next((item for item in ('total_assets', 'revenue') if item in items), None)
+    if base is None or base not in items:
+        raise ValueError('base line item not found: %s' % (base or 'total_assets or revenue'))
+    with instrument.span('finPy.analysis', analysis='vertical', rows=len(statement)):
+        if panel:
+            data = statement.select_dtypes('number')
+            return data.div(data[base], axis=0) * 100
+        data = statement[_chronological(statement.columns)].apply(pd.to_numeric, errors='coerce')
+        return data.div(data.loc[base], axis=1) * 100
 
 
 def horizontalAnalysisLastTwo(dataframe):
     statement = dataframe
     statement = statement.reindex(sorted(statement.columns), axis=1)
-    statement_lastPeriods = statement[statement.columns[-2:]]
-    statement_lastPeriods_lastColName = statement[statement_lastPeriods.columns[-1:]].columns.values[0]
-    statement_lastPeriods_secondLastColName = statement[statement_lastPeriods.columns[-2:-1]].columns.values[0]
-    statement_lastPeriods['Amount(Increased/Decreased)'] = statement_lastPeriods[statement_lastPeriods_lastColName] - \
-                                                           statement_lastPeriods[
-                                                               statement_lastPeriods_secondLastColName]
-    statement_lastPeriods['Percentage(Increased/Decreased)'] = (statement_lastPeriods[
-                                                                    statement_lastPeriods_lastColName] /
-                                                                statement_lastPeriods[
-                                                                    statement_lastPeriods_secondLastColName]) - 1
+    statement_lastPeriods = statement[statement.columns[-2:]].copy()
+    change = horizontal_analysis(statement_lastPeriods)
+    statement_lastPeriods['Amount(Increased/Decreased)'] = change['amount'].iloc[:, -1]
+    statement_lastPeriods['Percentage(Increased/Decreased)'] = change['percent'].iloc[:, -1]
     statement_lastPeriods = statement_lastPeriods.dropna()
-    statement_lastPeriods['Percentage(Increased/Decreased)'] = pd.Series(
-        ["{0:.2f}%".format(val * 100) for val in statement_lastPeriods['Percentage(Increased/Decreased)']],
-        index=statement_lastPeriods.index)
+    statement_lastPeriods['Percentage(Increased/Decreased)'] = \
+        statement_lastPeriods['Percentage(Increased/Decreased)'].map('{0:.2f}%'.format)
     statement_lastPeriods.to_csv('horizontalAnalysisLastTwo.csv')
     print("Horizontal Analysis with Last two Periods", statement_lastPeriods, sep='\n')
 
 
-def _process_symbol(symbol: str):
-    df_income = get_annual_finData_by_symbol('income', symbol, 'us')
-    df_balancesheet = get_annual_finData_by_symbol('balancesheet', symbol, 'us')
+def _process_symbol(symbol: str, country='us'):
+    df_income = get_annual_finData_by_symbol('income', symbol, country)
+    df_balancesheet = get_annual_finData_by_symbol('balancesheet', symbol, country)
 
     ret = calculateMetrics(df_balancesheet, df_income)
     ret = ret.T
@@ -224,9 +665,75 @@ def _process_symbol(symbol: str):
     return ret
 
 
-def calculate_ratio_mass(symbols):
-    concate = pd.DataFrame()
-    for symbol in symbols:
-        ratio = _process_symbol(symbol)
-        concate = pd.concat([concate, ratio])
-    return concate
+def _statement_panel(dataset, symbols, country, columns=None):
+    # Line items of the symbols (or the whole market) with lower case names, indexed by Ticker and fiscal_year
+    df, rows = _market_data(dataset, country, columns=columns)
+    if not (isinstance(symbols, str) and symbols == 'all'):
+        positions = [rows[symbol] for symbol in symbols if symbol in rows]
+        df = df.iloc[np.concatenate(positions)] if positions else df.iloc[:0]
+    df = df.drop(columns=['SimFinId', 'Currency', 'Fiscal_Period', 'Report_Date', 'Publish_Date',
+                          'Restated_Date'], errors='ignore')
+    df.columns = df.columns.str.lower()
+    df.index.names = ['Ticker', 'fiscal_year']
+    return df
+
+
+def get_statement_panel(category, symbols, country='us'):
+    # Statements of a list of symbols (or "all") as a Ticker/fiscal_year panel, for horizontal_analysis
+    # and vertical_analysis; category: income, balancesheet or cashflow
+    if category not in SIMFIN_DATASETS:
+        raise ValueError('Not a valid category')
+    return _statement_panel(SIMFIN_DATASETS[category], symbols, country)
+
+
+def iter_statement_json(category, symbols='all', country='us'):
+    # One JSON document per company, {"ticker": ..., "statement": ..., "data": {line_item: {year: value}}},
+    # serialized straight from the market store, so a whole market can be exported one company at a time
+    if category not in SIMFIN_DATASETS:
+        raise ValueError('Not a valid category')
+    panel = _statement_panel(SIMFIN_DATASETS[category], symbols, country)
+    header = '{"ticker":%s,"statement":' + json.dumps(category) + ',"data":%s}'
+    for ticker, statement in panel.groupby(level=0, sort=False):
+        yield header % (json.dumps(ticker), statement.droplevel(0).to_json(orient='columns'))
+
+
+def write_statement_ndjson(path, category, symbols='all', country='us'):
+    # iter_statement_json written as newline delimited JSON; returns the number of companies
+    companies = 0
+    with instrument.span('finPy.json', statement=category) as span, open(os.path.expanduser(path), 'w') as handle:
+        for line in iter_statement_json(category, symbols, country):
+            handle.write(line + '\n')
+            companies += 1
+        span.set(rows=companies)
+    return companies
+
+
+def _ratio_panel(symbols, country):
+    # Income and balance are joined on (Ticker, fiscal_year) once and every ratio is computed column-wise;
+    # averages are taken per ticker over its years, as calculateMetrics does for one company
+    balance = _statement_panel('balance', symbols, country, 'ratios')
+    income = _statement_panel('income', symbols, country, 'ratios')
+    panel = balance.join(income.drop(columns=balance.columns.intersection(income.columns)), how='outer')
+    ratios = evaluate_ratios(panel).round(4)
+    if not (isinstance(symbols, str) and symbols == 'all'):
+        order = {symbol: position for position, symbol in enumerate(dict.fromkeys(symbols))}
+        tickers = ratios.index.get_level_values(0).map(order)
+        ratios = ratios.iloc[np.argsort(np.asarray(tickers), kind='stable')]
+    return ratios
+
+
+def calculate_ratio_mass(symbols, country='us', engine='panel'):
+    # symbols: list of tickers or "all" for the whole market (panel engine only).
+    # The panel engine computes the ratios of all symbols together; engine='loop' runs calculateMetrics
+    # symbol by symbol. Both return the same Ticker/fiscal_year indexed frame.
+    if engine not in ('panel', 'loop'):
+        raise ValueError("engine must be 'panel' or 'loop'")
+    count = 'all' if isinstance(symbols, str) else len(symbols)
+    with instrument.span('finPy.ratio_mass', symbols=count, engine=engine) as span:
+        if engine == 'panel':
+            ratios = _ratio_panel(symbols, country)
+        else:
+            frames = [_process_symbol(symbol, country) for symbol in symbols]
+            ratios = pd.concat(frames) if frames else pd.DataFrame()
+        span.set(rows=len(ratios))
+    return ratios
@@ -0,0 +1,186 @@
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+# Opt-in timing of the hot paths of suPy, statsPy and finPy: csv parsing, cache hits and misses,
+# per-product filters, resampling, model fits and plotting.
+# Spans record wall time, rows processed and (with memory=True) the tracemalloc peak above the
+# memory in use when the span started; counters record events such as cache hits.
+# Records are dicts passed to every enabled sink. With no sink enabled, span() and count() return
+# after a single check, so the instrumented code runs at full speed.
+# It can also be switched on with the GUSPI_TRACE=<file.jsonl> environment variable.
+
+_SINKS = []
+_MEMORY = False
+_STACK = threading.local()
+
+
+class LoggingSink:
+    # Records as log lines on the 'GusPI' logger (or the logger given)
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('GusPI')
+        self.level = level
+
+    def __call__(self, record):
+        fields = ' '.join('%s=%s' % (key, value) for key, value in record.items() if key not in ('event', 'name'))
+        self.logger.log(self.level, '%s %s %s', record['event'], record['name'], fields)
+
+
+class MemorySink:
+    # Records kept in a list; summary() totals them per span or counter name
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def clear(self):
+        with self._lock:
+            self.records = []
+
+    def summary(self):
+        import pandas as pd
+        columns = ['event', 'name', 'calls', 'seconds', 'rows', 'peak_bytes', 'value']
+        if not self.records:
+            return pd.DataFrame(columns=columns)
+        records = pd.DataFrame(self.records)
+        for column in ['seconds', 'rows', 'peak_bytes', 'value']:
+            if column not in records:
+                records[column] = float('nan')
+        summary = records.groupby(['event', 'name'], sort=False).agg(
+            calls=('name', 'size'), seconds=('seconds', 'sum'), rows=('rows', 'sum'),
+            peak_bytes=('peak_bytes', 'max'), value=('value', 'sum'))
+        return summary.reset_index().sort_values('seconds', ascending=False, ignore_index=True)
+
+
+class JsonLinesSink:
+    # Records appended to a file as one JSON object per line; safe to share between processes
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(os.fspath(path))
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self._lock, open(self.path, 'a') as handle:
+            handle.write(line)
+
+
+def enable(*sinks, memory=False):
+    # Start sending records to the sinks (a MemorySink when none is given) and return the first sink.
+    # memory=True also tracks the peak memory of every span through tracemalloc, which slows numpy and
+    # pandas allocations down noticeably.
+    global _MEMORY
+    if not sinks:
+        sinks = (MemorySink(),)
+    _SINKS[:] = sinks
+    _MEMORY = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return sinks[0]
+
+
+def disable():
+    global _MEMORY
+    _SINKS[:] = []
+    if _MEMORY and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _MEMORY = False
+
+
+def is_enabled():
+    return bool(_SINKS)
+
+
+def _emit(record):
+    record['pid'] = os.getpid()
+    record['timestamp'] = time.time()
+    for sink in list(_SINKS):
+        sink(record)
+
+
+def count(name, value=1, **fields):
+    if not _SINKS:
+        return
+    record = {'event': 'counter', 'name': name, 'value': value}
+    record.update(fields)
+    _emit(record)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **fields):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+
+    def __init__(self, name, fields):
+        self.record = {'event': 'span', 'name': name}
+        self.record.update(fields)
+        self.peak = 0
+
+    def set(self, **fields):
+        # Add fields known only inside the span, such as the number of rows parsed
+        self.record.update(fields)
+
+    def __enter__(self):
+        stack = getattr(_STACK, 'spans', None)
+        if stack is None:
+            stack = _STACK.spans = []
+        if _MEMORY and tracemalloc.is_tracing():
+            # The peak is reset per span; the parent keeps the peak reached so far
+            self.base, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+        else:
+            self.base = None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        stack = _STACK.spans
+        stack.pop()
+        self.record['seconds'] = seconds
+        if self.base is not None and tracemalloc.is_tracing():
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            self.record['peak_bytes'] = self.peak - self.base
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+        if stack:
+            self.record['parent'] = stack[-1].record['name']
+        if exc_type is not None:
+            self.record['error'] = exc_type.__name__
+        _emit(self.record)
+        return False
+
+
+def span(name, **fields):
+    # with instrument.span('suPy.parse', file=path) as s: ...; s.set(rows=len(frame))
+    if not _SINKS:
+        return _NULL_SPAN
+    return _Span(name, fields)
+
+
+if os.environ.get('GUSPI_TRACE'):
+    enable(JsonLinesSink(os.environ['GUSPI_TRACE']))
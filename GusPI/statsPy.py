@@ -1,12 +1,11 @@
 import os
-from scipy.stats import chisquare
-from scipy.stats import ks_2samp
-from scipy.stats import combine_pvalues
-import plotly.graph_objects as go
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
-from fbprophet import Prophet
+from GusPI import display, instrument
+
+# scipy, matplotlib, plotly and Prophet are imported by the functions that use them,
+# so compute-only use of this module starts fast
 
 
 def init_df(df, colname, target, target_value):
@@ -24,16 +23,50 @@ def init_df(df, colname, target, target_value):
 # Benford's Law percentages
 BENFORDLD = [30.1, 17.6, 12.5, 9.7, 7.9, 6.7, 5.8, 5.1, 4.6]
 
+# Digit tests: first digit (1-9), second digit (0-9) and first two digits (10-99)
+BENFORD_TESTS = ('first', 'second', 'first_two')
+
+
+def _benford_digits(test):
+    if test == 'first':
+        return list(range(1, 10))
+    if test == 'second':
+        return list(range(0, 10))
+    if test == 'first_two':
+        return list(range(10, 100))
+    raise ValueError("test must be one of: " + ", ".join(BENFORD_TESTS))
 
-# process
-def process_benfordlaw(value_arr, alpha=0.05, verbose=3):
-    [counts_emp, percentage_emp, total_count, digit] = _count_first_digit(value_arr)
-    counts_exp = _get_expected_counts(total_count)
 
-    # get p-value
-    [tstats1, Praw1] = chisquare(counts_emp, f_exp=counts_exp)
+def _benford_percentages(test):
+    if test == 'first':
+        return BENFORDLD
+    if test == 'second':
+        first = np.arange(1, 10)[:, None]
+        return list(np.log10(1 + 1 / (10 * first + np.arange(10))).sum(axis=0) * 100)
+    return list(np.log10(1 + 1 / np.arange(10, 100)) * 100)
+
+
+# process
+def process_benfordlaw(value_arr, alpha=0.05, verbose=3, test='first'):
+    with instrument.span('statsPy.benford_count', test=test, rows=len(value_arr)):
+        [counts_emp, percentage_emp, total_count, digit] = _count_digits(value_arr, test)
+    counts_exp = _get_expected_counts(total_count, test)
+    tstats, Praw = _benford_pvalues(counts_emp, counts_exp)
+    return _benford_result(percentage_emp, digit, tstats, Praw, alpha, verbose, test)
+
+
+def _benford_pvalues(counts_emp, counts_exp):
+    from scipy.stats import chisquare, ks_2samp, combine_pvalues
+    # Rounded expected counts are rescaled to the observed total, which chisquare requires
+    counts_exp = np.asarray(counts_exp, dtype=float)
+    f_exp = counts_exp * (np.sum(counts_emp) / counts_exp.sum())
+    [tstats1, Praw1] = chisquare(counts_emp, f_exp=f_exp)
     [tstats2, Praw2] = ks_2samp(counts_emp, counts_exp)
     tstats, Praw = combine_pvalues([Praw1, Praw2], method='fisher')
+    return tstats, Praw
+
+
+def _benford_result(percentage_emp, digit, tstats, Praw, alpha, verbose, test):
     method = 'P_ensemble'
 
     if Praw <= alpha and verbose >= 3:
@@ -46,35 +79,176 @@ def process_benfordlaw(value_arr, alpha=0.05, verbose=3):
     result['tstats'] = tstats
     result['alpha'] = alpha
     result['method'] = method
+    result['test'] = test
     result['percentage_emp'] = np.c_[digit, percentage_emp]
     return (result)
 
 
-def _count_first_digit(data):
-    data = data[data > 1]
-    first_digits = list(map(lambda x: int(str(x)[0]), data))
+def _first_two_digits(data):
+    # First two significant digits (10-99) of every non-zero finite value, from log10 arithmetic.
+    # Negative amounts count by their absolute value and amounts below 1 by their significant digits.
+    # The mantissa is rounded to 14 significant digits so binary noise such as 0.29 -> 28.999999999999996
+    # is ignored.
+    data = np.abs(np.asarray(data, dtype=float))
+    data = data[np.isfinite(data) & (data > 0)]
+    exponent = np.floor(np.log10(data)) - 1
+    scaled = np.round(data / np.power(10.0, exponent), 12)
+    scaled = np.where(scaled >= 100, scaled / 10, scaled)
+    scaled = np.where(scaled < 10, scaled * 10, scaled)
+    return np.floor(scaled).astype(np.int64)
+
+
+def _digit_counts(first_two, test):
+    if test == 'first':
+        return np.bincount(first_two // 10, minlength=10)[1:]
+    if test == 'second':
+        return np.bincount(first_two % 10, minlength=10)
+    return np.bincount(first_two, minlength=100)[10:]
+
+
+def _count_digits(data, test='first'):
+    digit = _benford_digits(test)
+    emperical_counts = _digit_counts(_first_two_digits(data), test).astype(float)
+    total_count = emperical_counts.sum()
+    emperical_percentage = emperical_counts / total_count * 100 if total_count else emperical_counts * np.nan
+    return (emperical_counts, emperical_percentage, total_count, digit)
 
-    emperical_counts = np.zeros(9)
-    digit = []
-    for i in range(1, 10):
-        emperical_counts[i - 1] = first_digits.count(i)
-        digit.append(i)
 
-    total_count = sum(emperical_counts)
-    emperical_percentage = [(i / total_count) * 100 for i in emperical_counts]
-    return (emperical_counts, emperical_percentage, total_count, digit)
+def _count_first_digit(data):
+    return _count_digits(data, 'first')
 
 
-def _get_expected_counts(total_count):
+def _get_expected_counts(total_count, test='first'):
     result = []
-    for p in BENFORDLD:
+    for p in _benford_percentages(test):
         result.append(round(p * total_count / 100))
 
     return (result)
 
 
+class BenfordCounter:
+    # Benford digit counts that are updated chunk by chunk, merged across partitions and saved to disk,
+    # for ledgers that are split over many files or do not fit in memory.
+    # The first two digits are counted, which also gives the first and second digit counts.
+
+    def __init__(self):
+        self.counts = np.zeros(90, dtype=np.int64)
+
+    def update(self, values):
+        with instrument.span('statsPy.benford_count', rows=len(values)):
+            self.counts += np.bincount(_first_two_digits(values) - 10, minlength=90)
+        return self
+
+    def update_from(self, chunks):
+        for chunk in chunks:
+            self.update(chunk)
+        return self
+
+    def update_csv(self, file, colname, chunksize=1000000):
+        for chunk in pd.read_csv(file, usecols=[colname], chunksize=chunksize):
+            self.update(chunk[colname].values)
+        return self
+
+    def merge(self, other):
+        self.counts += other.counts
+        return self
+
+    def digit_counts(self, test='first'):
+        _benford_digits(test)
+        if test == 'first':
+            return self.counts.reshape(9, 10).sum(axis=1)
+        if test == 'second':
+            return self.counts.reshape(9, 10).sum(axis=0)
+        return self.counts.copy()
+
+    def result(self, alpha=0.05, verbose=3, test='first'):
+        # Same result dict as process_benfordlaw on all values seen so far
+        counts_emp = self.digit_counts(test).astype(float)
+        total_count = counts_emp.sum()
+        percentage_emp = counts_emp / total_count * 100 if total_count else counts_emp * np.nan
+        counts_exp = _get_expected_counts(total_count, test)
+        tstats, Praw = _benford_pvalues(counts_emp, counts_exp)
+        return _benford_result(percentage_emp, _benford_digits(test), tstats, Praw, alpha, verbose, test)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.save(f, self.counts)
+
+    @classmethod
+    def load(cls, path):
+        counter = cls()
+        with open(path, 'rb') as f:
+            counter.counts = np.load(f)
+        return counter
+
+
+def _digit_bins(first_two, test):
+    # Column of every value in a digit count matrix (see _benford_digits)
+    if test == 'first':
+        return first_two // 10 - 1
+    if test == 'second':
+        return first_two % 10
+    return first_two - 10
+
+
+def _benford_scan_pvalues(counts, test):
+    tstats = np.full(len(counts), np.nan)
+    pvalues = np.full(len(counts), np.nan)
+    for i, counts_emp in enumerate(counts):
+        total_count = counts_emp.sum()
+        if total_count > 0:
+            tstats[i], pvalues[i] = _benford_pvalues(counts_emp, _get_expected_counts(total_count, test))
+    return tstats, pvalues
+
+
+def benford_scan(df, value_col, group_col, test='first', alpha=0.05, processes=1):
+    # Benford's Law test of every group (e.g. GL account) of a dataframe.
+    # Digits of all rows are counted per group in one pass; the p-values are computed per group,
+    # over a pool of processes when processes is not 1 (None uses every cpu).
+    # Returns one row per group ranked from the most to the least anomalous.
+    digit = _benford_digits(test)
+    with instrument.span('statsPy.benford_count', test=test, rows=len(df)):
+        values = np.abs(np.asarray(df[value_col], dtype=float))
+        codes, groups = pd.factorize(df[group_col])
+        valid = np.isfinite(values) & (values > 0) & (codes >= 0)
+        bins = _digit_bins(_first_two_digits(values[valid]), test)
+        counts = np.bincount(codes[valid] * len(digit) + bins, minlength=len(groups) * len(digit))
+        counts = counts.reshape(len(groups), len(digit)).astype(float)
+
+    if processes == 1 or len(groups) < 2:
+        tstats, pvalues = _benford_scan_pvalues(counts, test)
+    else:
+        workers = processes or os.cpu_count() or 1
+        chunks = np.array_split(np.arange(len(groups)), min(workers * 4, len(groups)))
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(_benford_scan_pvalues, [counts[chunk] for chunk in chunks],
+                                        [test] * len(chunks)))
+        tstats = np.concatenate([result[0] for result in results])
+        pvalues = np.concatenate([result[1] for result in results])
+
+    total_count = counts.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        percentage_emp = counts / total_count[:, None] * 100
+    result = pd.DataFrame({group_col: np.asarray(groups), 'count': total_count.astype(np.int64),
+                           'p-value': pvalues, 'tstats': tstats, 'anomaly': pvalues <= alpha})
+    for i, d in enumerate(digit):
+        result['pct_%d' % d] = percentage_emp[:, i]
+    result = result.sort_values(['p-value', 'tstats'], ascending=[True, False], na_position='last')
+    result = result.reset_index(drop=True)
+    result.insert(0, 'rank', np.arange(1, len(result) + 1))
+    return result
+
+
 # Plot
 def plot_benfordlaw(result, title='', figsize=(15, 8)):
+    if display.is_headless():
+        return None, None
+    with instrument.span('statsPy.plot', plot='benford'):
+        return _draw_benfordlaw(result, title, figsize)
+
+
+def _draw_benfordlaw(result, title, figsize):
+    import matplotlib.pyplot as plt
     fontsize = 16
 
     data_percentage = result['percentage_emp']
@@ -91,7 +265,8 @@ def plot_benfordlaw(result, title='', figsize=(15, 8)):
                 fontsize=13)
 
     # Plot expected benfords values
-    ax.scatter(x, BENFORDLD, s=150, c='orange', zorder=3, label='Benfords distribution')
+    ax.scatter(x, _benford_percentages(result.get('test', 'first')), s=150, c='orange', zorder=3,
+               label='Benfords distribution')
 
     if result['p-value'] <= result['alpha']:
         title = title + "\nAnomaly detected! P-value=%g, Tstat=%g" % (result['p-value'], result['tstats'])
@@ -115,17 +290,60 @@ def plot_benfordlaw(result, title='', figsize=(15, 8)):
 
 
 def _fit_predict_model(dataframe, interval_width=0.99, changepoint_range=0.8):
-    m = Prophet(daily_seasonality=False, yearly_seasonality=False, weekly_seasonality=False,
-                seasonality_mode='multiplicative',
-                interval_width=interval_width,
-                changepoint_range=changepoint_range)
-    m = m.fit(dataframe)
-
-    pred = m.predict(dataframe)
+    with instrument.span('statsPy.prophet_fit', rows=len(dataframe)):
+        from fbprophet import Prophet
+        m = Prophet(daily_seasonality=False, yearly_seasonality=False, weekly_seasonality=False,
+                    seasonality_mode='multiplicative',
+                    interval_width=interval_width,
+                    changepoint_range=changepoint_range)
+        m = m.fit(dataframe)
+
+        pred = m.predict(dataframe)
     pred['mark'] = dataframe['y'].reset_index(drop=True)
     return pred
 
 
+def _mad_predict(dataframe, group_col=None, window=15, n_sigmas=3.0):
+    # Rolling median/MAD bands in the layout of _fit_predict_model, without fitting a model.
+    # The band is yhat +/- n_sigmas * 1.4826 * MAD over a centred window of `window` calendar days, so days
+    # without data shrink the window instead of stretching it; a window with a MAD of 0 falls back to the
+    # MAD of the whole series so constant stretches do not flag every change.
+    with instrument.span('statsPy.mad_predict', rows=len(dataframe)):
+        return _mad_bands(dataframe, group_col, window, n_sigmas)
+
+
+def _mad_bands(dataframe, group_col, window, n_sigmas):
+    dataframe = dataframe.reset_index(drop=True)
+    y = dataframe['y'].astype(float)
+    keys = dataframe[group_col] if group_col is not None else pd.Series(0, index=dataframe.index)
+    codes = pd.factorize(keys)[0]
+    # Rows sorted by group and day, so every group's time-based window runs over its own days in order
+    order = np.lexsort((dataframe['ds'].values, codes))
+    ordered = pd.DataFrame({'group': codes[order], 'ds': dataframe['ds'].values[order]})
+
+    def rolling_median(values):
+        ordered['value'] = values.values[order]
+        rolled = ordered.groupby('group', sort=True).rolling(
+            '%dD' % window, on='ds', center=True, min_periods=1)['value'].median()
+        result = np.empty(len(values))
+        result[order] = rolled.values
+        return pd.Series(result, index=values.index)
+
+    median = rolling_median(y)
+    deviation = (y - median).abs()
+    mad = rolling_median(deviation)
+    grouped = y.groupby(keys, sort=False)
+    overall = (y - grouped.transform('median')).abs().groupby(keys, sort=False).transform('median')
+    scale = 1.4826 * mad.where(mad > 0, overall)
+
+    pred = pd.DataFrame({'ds': dataframe['ds'], 'trend': median, 'yhat': median,
+                         'yhat_lower': median - n_sigmas * scale, 'yhat_upper': median + n_sigmas * scale,
+                         'mark': y})
+    if group_col is not None:
+        pred.insert(0, group_col, dataframe[group_col])
+    return pred
+
+
 def _detect_anomalies(pred):
     predicted = pred[['ds', 'trend', 'yhat', 'yhat_lower', 'yhat_upper', 'mark']].copy()
 
@@ -133,7 +351,7 @@ def _detect_anomalies(pred):
     predicted.loc[predicted['mark'] > predicted['yhat_upper'], 'anomaly'] = 1
     predicted.loc[predicted['mark'] < predicted['yhat_lower'], 'anomaly'] = -1
 
-    predicted['importance'] = 0
+    predicted['importance'] = 0.0
     predicted.loc[predicted['anomaly'] == 1, 'importance'] = \
         (predicted['mark'] - predicted['yhat_upper']) / predicted['mark']
     predicted.loc[predicted['anomaly'] == -1, 'importance'] = \
@@ -142,20 +360,77 @@ def _detect_anomalies(pred):
     return predicted
 
 
-def anomalies_detection(df, col_to_filter, filter_value, target_col):
-    df = df.loc[df[col_to_filter] == filter_value]
-    df = df[['date', target_col]]
-    df['date'] = pd.to_datetime(df['date'], errors='coerce')
-    df = df.set_index('date').groupby(pd.Grouper(freq='D')).max()
-    df = df.reset_index()
-    df = df.dropna()
-    df.columns = ['ds', 'y']
-    pred = _fit_predict_model(df)
+def _daily_max(df, target_col, group_col=None):
+    # Daily maximum of target_col as a Prophet ds/y frame (with group_col in front when given)
+    with instrument.span('statsPy.resample', rule='D', rows=len(df)):
+        dates = pd.to_datetime(df['date'], errors='coerce').dt.floor('D').rename('ds')
+        keys = [dates] if group_col is None else [df[group_col], dates]
+        daily = df[target_col].groupby(keys, sort=True).max().rename('y').reset_index()
+    return daily.dropna()
+
+
+def plot_anomalies(pred, target_col, title='Detected Anomalies'):
+    if display.is_headless():
+        return None
+    with instrument.span('statsPy.plot', plot='anomalies', rows=len(pred)):
+        import plotly.graph_objects as go
+        pred_ano = pred.loc[pred['anomaly'] == 1]
+        fig = go.Figure()
+        fig.add_trace(go.Scatter(x=pred['ds'], y=pred['mark'], name=target_col, mode='lines'))
+        fig.add_trace(go.Scatter(x=pred_ano['ds'], y=pred_ano['mark'], mode='markers', name='Anomaly',
+                                 marker=dict(color='red')))
+        fig.update_layout(showlegend=True, title=title)
+        fig.show()
+    return fig
+
+
+def _check_engine(engine):
+    if engine not in ('prophet', 'mad'):
+        raise ValueError("engine must be 'prophet' or 'mad'")
+
+
+def anomalies_detection(df, col_to_filter, filter_value, target_col, engine='prophet'):
+    # engine='mad' uses rolling median/MAD bands instead of fitting a Prophet model
+    _check_engine(engine)
+    with instrument.span('statsPy.filter', rows=len(df)):
+        df = df.loc[df[col_to_filter] == filter_value]
+    df = _daily_max(df, target_col).reset_index(drop=True)
+    pred = _mad_predict(df) if engine == 'mad' else _fit_predict_model(df)
     pred = _detect_anomalies(pred)
-    pred_ano = pred.loc[pred['anomaly'] == 1]
-    fig = go.Figure()
-    fig.add_trace(go.Scatter(x=pred['ds'], y=pred['mark'], name=target_col, mode='lines'))
-    fig.add_trace(
-        go.Scatter(x=pred_ano['ds'], y=pred_ano['mark'], mode='markers', name='Anomaly', marker=dict(color='red')))
-    fig.update_layout(showlegend=True, title='Detected Anomalies')
-    fig.show()
+    plot_anomalies(pred, target_col)
+    return pred
+
+
+def _anomalies_worker(task):
+    group, series = task
+    pred = _detect_anomalies(_fit_predict_model(series))
+    pred.insert(0, 'group', group)
+    return pred
+
+
+def anomalies_detection_batch(df, group_col, target_col, processes=None, engine='prophet'):
+    # Anomaly detection for every value of group_col (e.g. every account or SKU).
+    # Prophet models are fitted over a pool of processes (processes=1 runs in-process); the mad engine
+    # computes the bands of all groups in one pass. No figure is drawn; pass the rows of one group to
+    # plot_anomalies to look at it. Groups with fewer than two days of data are left out.
+    _check_engine(engine)
+    daily = _daily_max(df, target_col, group_col)
+    if engine == 'mad':
+        daily = daily.loc[daily.groupby(group_col, sort=False)['y'].transform('size') >= 2]
+        pred = _mad_predict(daily, group_col)
+        return pd.concat([pred[[group_col]], _detect_anomalies(pred)], axis=1)
+    tasks = [(group, series[['ds', 'y']].reset_index(drop=True))
+             for group, series in daily.groupby(group_col, sort=False) if len(series) >= 2]
+
+    if processes == 1:
+        preds = [_anomalies_worker(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            workers = processes or os.cpu_count() or 1
+            chunksize = max(1, len(tasks) // (workers * 4))
+            preds = list(executor.map(_anomalies_worker, tasks, chunksize=chunksize))
+
+    if not preds:
+        return pd.DataFrame(columns=[group_col, 'ds', 'trend', 'yhat', 'yhat_lower', 'yhat_upper', 'mark',
+                                     'anomaly', 'importance'])
+    return pd.concat(preds, ignore_index=True).rename(columns={'group': group_col})
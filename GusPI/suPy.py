@@ -1,26 +1,292 @@
+import hashlib
 import math
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, time
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-from scipy.stats import norm
-from sklearn.model_selection import train_test_split
-from sklearn.linear_model import LinearRegression
-from sklearn import metrics
-from fbprophet import Prophet
-import helper
+from GusPI import display, instrument, statsPy
+
+# matplotlib, seaborn, scipy, sklearn and Prophet are imported by the functions that use them,
+# so compute-only use of this module starts fast
+
+
+# Directory of the on-disk cache of parsed sales files; None keeps the cache disabled
+_CACHE_DIR = os.environ.get('GUSPI_CACHE_DIR')
+
+
+def enableCache(directory='~/.guspi_cache'):
+    # Store parsed sales files as feather files so later runs skip the csv parse.
+    # Categorical and datetime columns are kept as they are; requires pyarrow.
+    global _CACHE_DIR
+    _CACHE_DIR = os.path.expanduser(directory)
+    os.makedirs(_CACHE_DIR, exist_ok=True)
+
+
+def disableCache():
+    global _CACHE_DIR
+    _CACHE_DIR = None
+
+
+def clearCache():
+    if _CACHE_DIR is None or not os.path.isdir(_CACHE_DIR):
+        return
+    for name in os.listdir(_CACHE_DIR):
+        if name.endswith('.feather'):
+            os.remove(os.path.join(_CACHE_DIR, name))
+
+
+def _cachePath(file):
+    # Keyed on path, size and modification time; a changed file gets a new cache entry
+    path = os.path.abspath(os.fspath(file))
+    stat = os.stat(path)
+    path_key = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    version_key = hashlib.sha1(('%d-%d' % (stat.st_size, stat.st_mtime_ns)).encode('utf-8')).hexdigest()
+    return os.path.join(_CACHE_DIR, path_key + '-' + version_key[:16] + '.feather')
+
+
+def _writeCache(sales, cache_path):
+    # Older versions of the same file are removed. The new entry is written under a temporary name of
+    # its own, so processes sharing the cache never write to the same file or see a partial entry.
+    prefix = os.path.basename(cache_path).split('-')[0] + '-'
+    for name in os.listdir(_CACHE_DIR):
+        if name.startswith(prefix) and name.endswith('.feather') and name != os.path.basename(cache_path):
+            try:
+                os.remove(os.path.join(_CACHE_DIR, name))
+            except FileNotFoundError:
+                pass
+    handle, temp_path = tempfile.mkstemp(dir=_CACHE_DIR, suffix='.tmp')
+    os.close(handle)
+    try:
+        sales.to_feather(temp_path)
+        os.replace(temp_path, cache_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
 
 
 def prep_dataframe(file):
-    sales = pd.read_csv(file)
-    sales['ref'] = sales['ref'].astype('category')
-    sales['date'] = pd.to_datetime(sales['date'], errors='coerce')
-    sales['product_number'] = sales['product_number'].astype('category')
-    sales['product_name'] = sales['product_name'].astype('category')
+    cache_path = None
+    if _CACHE_DIR is not None and isinstance(file, (str, os.PathLike)):
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        cache_path = _cachePath(file)
+        if os.path.exists(cache_path):
+            try:
+                with instrument.span('suPy.read_cache') as span:
+                    sales = pd.read_feather(cache_path)
+                    span.set(rows=len(sales))
+            except Exception:
+                # An unreadable entry is parsed again and replaced
+                sales = None
+            if sales is not None:
+                instrument.count('suPy.cache_hit')
+                return sales
+        instrument.count('suPy.cache_miss')
+
+    with instrument.span('suPy.parse') as span:
+        sales = pd.read_csv(file)
+        sales['ref'] = sales['ref'].astype('category')
+        sales['date'] = pd.to_datetime(sales['date'], errors='coerce')
+        sales['product_number'] = sales['product_number'].astype('category')
+        sales['product_name'] = sales['product_name'].astype('category')
+        span.set(rows=len(sales))
+
+    if cache_path is not None:
+        with instrument.span('suPy.write_cache', rows=len(sales)):
+            _writeCache(sales, cache_path)
     return sales
 
 
+class SalesDataset:
+    # Sales data parsed once by prep_dataframe and shared by every suPy function.
+    # Rows per product are located through a cached groupby index instead of a full-frame mask.
+
+    def __init__(self, sales):
+        self.sales = sales
+        self._product_rows = None
+
+    @classmethod
+    def from_file(cls, file):
+        return cls(prep_dataframe(file))
+
+    def product_numbers(self):
+        return self.sales['product_number'].dropna().unique()
+
+    def product(self, product_number):
+        with instrument.span('suPy.product_filter') as span:
+            if self._product_rows is None:
+                self._product_rows = self.sales.groupby('product_number', observed=True, sort=False).indices
+            rows = self._product_rows.get(product_number, [])
+            span.set(rows=len(rows))
+            return self.sales.iloc[rows].copy()
+
+
+def _as_dataset(file):
+    # Accept either a path to a sales csv file or an already parsed SalesDataset
+    if isinstance(file, SalesDataset):
+        return file
+    return SalesDataset.from_file(file)
+
+
+def readSalesChunks(file, chunksize=1000000):
+    # Read a sales csv file in chunks of rows so files larger than memory can be processed
+    chunks = iter(pd.read_csv(file, chunksize=chunksize))
+    while True:
+        with instrument.span('suPy.parse_chunk') as span:
+            chunk = next(chunks, None)
+            if chunk is not None:
+                chunk['date'] = pd.to_datetime(chunk['date'], errors='coerce')
+                span.set(rows=len(chunk))
+        if chunk is None:
+            return
+        yield chunk
+
+
+def _moments(values, keys):
+    # count, mean and sum of squared deviations (m2) of values per key
+    grouped = values.groupby(keys, observed=True, sort=False)
+    count = grouped.count()
+    moments = pd.DataFrame({'count': count, 'mean': grouped.mean(), 'm2': grouped.var(ddof=0) * count})
+    return moments.fillna(0)
+
+
+def _combineMoments(moments, level=0):
+    # Collapse moments of sub-groups (e.g. days, or the same key from several chunks) into moments per
+    # group of the given index level or levels (Chan et al. parallel form of Welford's algorithm).
+    # The groups are found once and the sums use their codes.
+    count = moments['count'].to_numpy(dtype=float)
+    grouped = pd.DataFrame({'count': count, 'total': moments['mean'].to_numpy() * count},
+                           index=moments.index).groupby(level=level, observed=True, sort=False)
+    sums = grouped.sum()
+    codes = grouped.ngroup().to_numpy()
+    group_count = sums['count'].to_numpy()
+    mean = sums['total'].to_numpy() / np.where(group_count > 0, group_count, 1)
+    deviation = moments['mean'].to_numpy() - mean[codes]
+    m2 = np.bincount(codes, weights=moments['m2'].to_numpy() + count * deviation ** 2, minlength=len(sums))
+    return pd.DataFrame({'count': sums['count'], 'mean': mean, 'm2': m2}, index=sums.index)
+
+
+def _yearlyTotals(dailyTotals):
+    # Quantity per product and year from the quantity per product and day
+    days = dailyTotals.index.get_level_values(1)
+    return dailyTotals.groupby([dailyTotals.index.get_level_values(0), days.year.rename('year')],
+                               observed=True).sum()
+
+
+class SalesAccumulator:
+    # Mergeable per-product quantity statistics that can be updated chunk by chunk.
+    # Memory grows with the number of products and days, not with the number of rows.
+    # The aggregates of new chunks are kept apart and combined with the state in one grouped pass once
+    # they are as large as the state (or when the state is read), so every row is combined a bounded
+    # number of times instead of re-aligning the whole state for every chunk.
+
+    def __init__(self):
+        self.names = None
+        self.moments = None
+        self.daily = None
+        self.yearly = None
+        self.dailyTotals = None
+        self._pending = []
+
+    def update(self, sales):
+        with instrument.span('suPy.accumulate', rows=len(sales)):
+            sales = sales.loc[sales['product_number'].notna()]
+            names = sales.drop_duplicates('product_number').set_index('product_number')['product_name']
+            moments = _moments(sales['quantity'], sales['product_number'])
+
+            dated = sales.loc[sales['date'].notna()]
+            daily = _moments(dated['quantity'], [dated['product_number'], dated['date'].dt.normalize()])
+
+            # Yearly totals only use complete rows, as avgQtySoldList always did. The daily totals of
+            # the same rows let evictBefore rebuild them for any cutoff day.
+            complete = sales.dropna()
+            dailyTotals = complete['quantity'].groupby(
+                [complete['product_number'], complete['date'].dt.normalize()], observed=True).sum()
+
+            self.merge(SalesAccumulator._from_parts(names, moments, daily, dailyTotals))
+        return self
+
+    @classmethod
+    def _from_parts(cls, names, moments, daily, dailyTotals):
+        accumulator = cls()
+        accumulator._pending = [(names, moments, daily, dailyTotals)]
+        return accumulator
+
+    def merge(self, other):
+        self._pending.extend(other._parts())
+        pending = sum(len(daily) for _, _, daily, _ in self._pending)
+        if pending >= (len(self.daily) if self.daily is not None else 0):
+            self.consolidate()
+        return self
+
+    def _parts(self):
+        parts = list(self._pending)
+        if self.names is not None:
+            parts.insert(0, (self.names, self.moments, self.daily, self.dailyTotals))
+        return parts
+
+    def consolidate(self):
+        # Combine the pending chunk aggregates with the state
+        if not self._pending:
+            return self
+        if self.names is None and len(self._pending) == 1:
+            self.names, self.moments, self.daily, self.dailyTotals = self._pending.pop()
+            self.yearly = _yearlyTotals(self.dailyTotals)
+            return self
+        names, moments, daily, dailyTotals = zip(*self._parts())
+        names = pd.concat(names)
+        self.names = names.loc[~names.index.duplicated()]
+        self.moments = _combineMoments(pd.concat(moments))
+        self.daily = _combineMoments(pd.concat(daily), level=[0, 1])
+        self.dailyTotals = pd.concat(dailyTotals).groupby(level=[0, 1], observed=True, sort=False).sum()
+        self.yearly = _yearlyTotals(self.dailyTotals)
+        self._pending = []
+        return self
+
+    def evictBefore(self, cutoff):
+        # Drop everything dated before cutoff. Moments are rebuilt from the daily buckets,
+        # so rows without a valid date no longer count once anything has been evicted.
+        cutoff = pd.Timestamp(cutoff)
+        self.consolidate()
+        if self.names is None:
+            return self
+        self.daily = self.daily.loc[self.daily.index.get_level_values(1) >= cutoff]
+        self.dailyTotals = self.dailyTotals.loc[self.dailyTotals.index.get_level_values(1) >= cutoff]
+        self.moments = _combineMoments(self.daily)
+        self.yearly = _yearlyTotals(self.dailyTotals)
+        self.names = self.names.loc[self.names.index.isin(self.moments.index)]
+        return self
+
+    def statistics(self):
+        self.consolidate()
+        if self.names is None:
+            return pd.DataFrame(columns=['product_number', 'product_name', 'count', 'avg_qty', 'std_qty',
+                                         'qty_sold_by_year', 'cv'])
+        products = self.names.index
+        moments = self.moments.reindex(products)
+        count = moments['count'].fillna(0)
+        stats = pd.DataFrame({'product_name': self.names.values}, index=products)
+        stats['count'] = count.values
+        stats['avg_qty'] = moments['mean'].where(count > 0).values
+        stats['std_qty'] = np.sqrt(moments['m2'] / (count - 1)).where(count > 1).values
+
+        # Same as resampling every product by year and averaging: years without sales count as zero
+        yearly = self.yearly.reset_index()
+        yearly = yearly.groupby('product_number', observed=True, sort=False).agg(
+            total=('quantity', 'sum'), first=('year', 'min'), last=('year', 'max'))
+        qty_sold_by_year = yearly['total'] / (yearly['last'] - yearly['first'] + 1)
+        stats['qty_sold_by_year'] = qty_sold_by_year.reindex(products).values
+
+        # Coefficient of variation of the daily average quantity, as in cvPerProduct
+        daily_mean = self.daily['mean'].where(self.daily['count'] > 0)
+        daily_mean = daily_mean.groupby(level=0, observed=True, sort=False)
+        stats['cv'] = (daily_mean.std() / daily_mean.mean()).reindex(products).values
+
+        stats.index.name = 'product_number'
+        return stats.reset_index()
+
+
 def EOQ(demand, mean, STD, C, Ce, Cs, Ct):
     Qs = math.sqrt(2 * Ct * demand / Ce)
     Ts = Qs / demand
@@ -132,66 +398,192 @@ def IOCT(TimeOrderShipped, TimeOrderReceived, NumberofOrdersShipped):
     # print("Internal Order Cycle Time: " + str(r))
 
 
+# Array versions of the KPIs above. They take numpy arrays, pandas Series or scalars, broadcast like numpy
+# and return the same floats as the scalar functions element by element. A Series argument gives a Series back.
+# Division by zero gives inf or nan instead of raising ZeroDivisionError.
+
+def _asFloat(values):
+    return np.asarray(values, dtype=float)
+
+
+def _arrayResult(result, *args):
+    for arg in args:
+        if isinstance(arg, pd.Series):
+            return pd.Series(result, index=arg.index)
+    return result
+
+
+def _productError(a, b, product):
+    # Exact rounding error of product = a * b (Dekker's two-product)
+    split = 134217729.0
+    t = split * a
+    a_hi = t - (t - a)
+    a_lo = a - a_hi
+    t = split * b
+    b_hi = t - (t - b)
+    b_lo = b - b_hi
+    return ((a_hi * b_hi - product) + a_hi * b_lo + a_lo * b_hi) + a_lo * b_lo
+
+
+def _round4(values):
+    # round(x, 4) for arrays with exactly the result of Python's correctly rounded round().
+    # x * 1e4 can itself be rounded onto a .5 tie, so ties are settled by the sign of the exact product error.
+    values = _asFloat(values)
+    shape = values.shape
+    values = values.ravel()
+    with np.errstate(over='ignore', invalid='ignore'):
+        scaled = values * 1e4
+        error = _productError(values, 1e4, scaled)
+        floor = np.floor(scaled)
+        rounded = np.rint(scaled)
+        tie = (scaled - floor) == 0.5
+        rounded = np.where(tie & (error > 0), floor + 1, rounded)
+        rounded = np.where(tie & (error < 0), floor, rounded)
+        result = rounded / 1e4
+    # Huge and non-finite values are left to Python's round
+    fallback = ~(np.abs(scaled) < 2.0 ** 52)
+    if fallback.any():
+        result[fallback] = [round(float(x), 4) for x in values[fallback]]
+    return result.reshape(shape)[()]
+
+
+def _asDays(dates):
+    # Parse %Y-%m-%d strings (or datetime-like values) in bulk to day numbers
+    shape = np.shape(dates)
+    parsed = pd.to_datetime(pd.Series(np.asarray(dates).ravel()), format='%Y-%m-%d')
+    days = parsed.values.astype('datetime64[D]').astype(np.int64)
+    return days.reshape(shape)[()]
+
+
+def EOQArray(demand, mean, STD, C, Ce, Cs, Ct):
+    demand, C, Ce, Ct = _asFloat(demand), _asFloat(C), _asFloat(Ce), _asFloat(Ct)
+    Qs = np.sqrt(2 * Ct * demand / Ce)
+    TRC = Ct * (demand / Qs) + Ce * (Qs / 2)
+    TC = C * demand + TRC
+    return _arrayResult(TC, demand, C, Ce, Ct)
+
+
+def POMArray(TotalOrders, ErrorOrders):
+    r = _round4((_asFloat(TotalOrders) - _asFloat(ErrorOrders)) / _asFloat(TotalOrders))
+    return _arrayResult(r, TotalOrders, ErrorOrders)
+
+
+def FRArray(TotalItems, ShippedItems):
+    r = _round4(1 - ((_asFloat(TotalItems) - _asFloat(ShippedItems)) / _asFloat(TotalItems)))
+    return _arrayResult(r, TotalItems, ShippedItems)
+
+
+def IDSArray(InventoryOnHand, AvgDailyUsage):
+    r = _round4(_asFloat(InventoryOnHand) / _asFloat(AvgDailyUsage))
+    return _arrayResult(r, InventoryOnHand, AvgDailyUsage)
+
+
+def FCUArray(TotalFreightCost, NumberOfItems):
+    r = _round4(_asFloat(TotalFreightCost) / _asFloat(NumberOfItems))
+    return _arrayResult(r, TotalFreightCost, NumberOfItems)
+
+
+def ITArray(COGS, AvgInventory):
+    r = _round4(_asFloat(COGS) / _asFloat(AvgInventory))
+    return _arrayResult(r, COGS, AvgInventory)
+
+
+def DOSArray(AvgInventory, MonthlyDemand):
+    r = _round4(_asFloat(AvgInventory) / _asFloat(MonthlyDemand)) * 30
+    return _arrayResult(r, AvgInventory, MonthlyDemand)
+
+
+def GMROIArray(GrossProfit, OpeningStock, ClosingStock):
+    r = _round4(_asFloat(GrossProfit) / ((_asFloat(OpeningStock) - _asFloat(ClosingStock)) / 2)) * 100
+    return _arrayResult(r, GrossProfit, OpeningStock, ClosingStock)
+
+
+def IAArray(ItemCounts, TotalItemCounts):
+    r = _round4(_asFloat(ItemCounts) / _asFloat(TotalItemCounts))
+    return _arrayResult(r, ItemCounts, TotalItemCounts)
+
+
+def SURArray(InventoryCube, TotalWarehouseCube):
+    r = _round4(_asFloat(InventoryCube) / _asFloat(TotalWarehouseCube)) * 100
+    return _arrayResult(r, InventoryCube, TotalWarehouseCube)
+
+
+def TOCTArray(TimeOrderReceivedbyCustomer, TimeOrderPlaced, TotalNumberofOrdersShipped):
+    days = _asDays(TimeOrderReceivedbyCustomer) - _asDays(TimeOrderPlaced)
+    r = _round4(days / _asFloat(TotalNumberofOrdersShipped))
+    return _arrayResult(r, TimeOrderReceivedbyCustomer, TimeOrderPlaced, TotalNumberofOrdersShipped)
+
+
+def IOCTArray(TimeOrderShipped, TimeOrderReceived, NumberofOrdersShipped):
+    days = _asDays(TimeOrderReceived) - _asDays(TimeOrderShipped)
+    r = _round4(days / _asFloat(NumberofOrdersShipped))
+    return _arrayResult(r, TimeOrderShipped, TimeOrderReceived, NumberofOrdersShipped)
+
+
+def _lineplotByMonth(data, column, title):
+    if display.is_headless():
+        return
+    with instrument.span('suPy.plot', plot='lineplot', rows=len(data)):
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+        plt.figure(figsize=(20, 9))
+        sns.lineplot(data=data, x='date', y=column).set_title(title)
+
+
 def lineplotQtyByMonth(file, product_number):
-    sales = prep_dataframe(file)
-    sales = sales.loc[sales['product_number'] == product_number]
+    sales = _as_dataset(file).product(product_number)
     sales_qty = sales[['date', 'quantity']]
-    sales_qty = sales_qty.set_index(["date"])
-    sales_qty = sales_qty.resample('M').sum()
+    with instrument.span('suPy.resample', rule='M', rows=len(sales_qty)):
+        sales_qty = sales_qty.set_index(["date"])
+        sales_qty = sales_qty.resample('M').sum()
     sales_qty = sales_qty.reset_index()
-    plt.figure(figsize=(20, 9))
-    sns.lineplot(data=sales_qty, x='date', y='quantity').set_title(product_number)
+    _lineplotByMonth(sales_qty, 'quantity', product_number)
 
 
 def lineplotTotalCostByMonth(file, product_number):
-    sales = prep_dataframe(file)
+    sales = _as_dataset(file).product(product_number)
     sales['total_cost'] = sales['quantity'] * sales['cost']
-    sales = sales.loc[sales['product_number'] == product_number]
     sales_qty = sales[['date', 'total_cost']]
-    sales_qty = sales_qty.set_index(["date"])
-    sales_qty = sales_qty.resample('M').sum()
+    with instrument.span('suPy.resample', rule='M', rows=len(sales_qty)):
+        sales_qty = sales_qty.set_index(["date"])
+        sales_qty = sales_qty.resample('M').sum()
     sales_qty = sales_qty.reset_index()
-    plt.figure(figsize=(20, 9))
-    sns.lineplot(data=sales_qty, x='date', y='total_cost').set_title(product_number)
+    _lineplotByMonth(sales_qty, 'total_cost', product_number)
 
 
 def lineplotTotalSalesByMonth(file, product_number):
-    sales = prep_dataframe(file)
+    sales = _as_dataset(file).product(product_number)
     sales['total_sales'] = sales['quantity'] * sales['price']
-    sales = sales.loc[sales['product_number'] == product_number]
     sales_qty = sales[['date', 'total_sales']]
-    sales_qty = sales_qty.set_index(["date"])
-    sales_qty = sales_qty.resample('M').sum()
+    with instrument.span('suPy.resample', rule='M', rows=len(sales_qty)):
+        sales_qty = sales_qty.set_index(["date"])
+        sales_qty = sales_qty.resample('M').sum()
     sales_qty = sales_qty.reset_index()
-    plt.figure(figsize=(20, 9))
-    sns.lineplot(data=sales_qty, x='date', y='total_sales').set_title(product_number)
+    _lineplotByMonth(sales_qty, 'total_sales', product_number)
 
 
 def lineplotAverageCostByMonth(file, product_number):
-    sales = prep_dataframe(file)
-    sales = sales.loc[sales['product_number'] == product_number]
+    sales = _as_dataset(file).product(product_number)
     sales_qty = sales[['date', 'cost']]
-    sales_qty = sales_qty.set_index(["date"])
-    sales_qty = sales_qty.resample('M').mean()
+    with instrument.span('suPy.resample', rule='M', rows=len(sales_qty)):
+        sales_qty = sales_qty.set_index(["date"])
+        sales_qty = sales_qty.resample('M').mean()
     sales_qty = sales_qty.reset_index()
-    plt.figure(figsize=(20, 9))
-    sns.lineplot(data=sales_qty, x='date', y='cost').set_title(product_number)
+    _lineplotByMonth(sales_qty, 'cost', product_number)
 
 
 def lineplotAverageSalesPriceByMonth(file, product_number):
-    sales = prep_dataframe(file)
-    sales = sales.loc[sales['product_number'] == product_number]
+    sales = _as_dataset(file).product(product_number)
     sales_qty = sales[['date', 'price']]
-    sales_qty = sales_qty.set_index(["date"])
-    sales_qty = sales_qty.resample('M').mean()
+    with instrument.span('suPy.resample', rule='M', rows=len(sales_qty)):
+        sales_qty = sales_qty.set_index(["date"])
+        sales_qty = sales_qty.resample('M').mean()
     sales_qty = sales_qty.reset_index()
-    plt.figure(figsize=(20, 9))
-    sns.lineplot(data=sales_qty, x='date', y='price').set_title(product_number)
+    _lineplotByMonth(sales_qty, 'price', product_number)
 
 
 def basicSafetyStock(file, productNumber, safetyDays, leadTimeinDays):
-    sales = prep_dataframe(file)
-    sales = sales.loc[sales['product_number'] == productNumber]
+    sales = _as_dataset(file).product(productNumber)
     sales_qty = sales.set_index(["date"])
     sales_qty = sales_qty.reset_index()
     avg_sales = sales_qty.quantity.mean()
@@ -201,27 +593,92 @@ def basicSafetyStock(file, productNumber, safetyDays, leadTimeinDays):
     print("Reorder Point: " + str(reorder_point))
 
 
-def basicSafetyStockList(file, safetyDays, leadTime):
-    sales = prep_dataframe(file)
+def productStatistics(file, chunksize=None):
+    # Quantity statistics for every product in one grouped pass: count, mean, standard deviation,
+    # average quantity sold per year and coefficient of variation of the daily average quantity.
+    # With chunksize the csv file is streamed in chunks of rows and memory stays bounded.
+    accumulator = SalesAccumulator()
+    if chunksize is None or isinstance(file, SalesDataset):
+        accumulator.update(_as_dataset(file).sales)
+    else:
+        for chunk in readSalesChunks(file, chunksize):
+            accumulator.update(chunk)
+    return accumulator.statistics()
+
+
+def _basicSafetyStockFrame(stats, safetyDays, leadTime):
+    result = stats[['product_number', 'product_name']].copy()
+    result['safety_stock'] = stats['avg_qty'] * safetyDays
+    result['reorder_point'] = result['safety_stock'] + stats['avg_qty'] * leadTime
+    return result
+
+
+def _serviceRateSafetyStockFrame(stats, serviceRate, leadTimeInDays):
+    from scipy.stats import norm
+    result = stats[['product_number', 'product_name']].copy()
+    servZ = norm.ppf(serviceRate)
+    LT_sqrt = math.sqrt(leadTimeInDays / 30)
+    result['safety_stock'] = servZ * stats['std_qty'] * LT_sqrt
+    result['reorder_point'] = result['safety_stock'] + stats['avg_qty'] * leadTimeInDays
+    return result
+
+
+def basicSafetyStockList(file, safetyDays, leadTime, chunksize=None):
+    stats = productStatistics(file, chunksize)
     pd.set_option('display.float_format', lambda x: '%.2f' % x)
-    result = pd.DataFrame(columns=['product_number', 'product_name', 'safety_stock', 'reorder_point'])
-    for pnum in sales.product_number.unique():
-        sales_prep = sales.loc[sales['product_number'] == pnum]
-        sales_qty = sales_prep.set_index(["date"])
-        sales_qty = sales_qty.reset_index()
-        avg_sales = sales_qty.quantity.mean()
-        safety_stock = avg_sales * safetyDays
-        reorder_point = safety_stock + avg_sales * leadTime
-        result = result.append(
-            {'product_number': pnum, 'product_name': sales_prep['product_name'].iloc[0], 'safety_stock': safety_stock,
-             'reorder_point': reorder_point}, ignore_index=True)
+    result = _basicSafetyStockFrame(stats, safetyDays, leadTime)
     result.to_csv('basicSafetyStock.csv')
     print("Saftey Stock and reorder point with basic method", result, sep='\n')
+    return result
+
+
+class SafetyStockCalculator:
+    # Safety stock and reorder points that are refreshed from new sales rows only.
+    # The running statistics can be saved and loaded between batch runs; with windowDays
+    # only the most recent days of sales are kept and older days are evicted.
+
+    def __init__(self, windowDays=None):
+        self.windowDays = windowDays
+        self.accumulator = SalesAccumulator()
+
+    def update(self, file, chunksize=None):
+        # file: path to a csv file with new rows, SalesDataset or dataframe
+        if isinstance(file, pd.DataFrame):
+            chunks = [file]
+        elif isinstance(file, SalesDataset):
+            chunks = [file.sales]
+        elif chunksize is not None:
+            chunks = readSalesChunks(file, chunksize)
+        else:
+            chunks = [prep_dataframe(file)]
+        for chunk in chunks:
+            self.accumulator.update(chunk)
+        self.accumulator.consolidate()
+        if self.windowDays is not None and self.accumulator.daily is not None and len(self.accumulator.daily):
+            latest = self.accumulator.daily.index.get_level_values(1).max()
+            self.accumulator.evictBefore(latest - pd.Timedelta(days=self.windowDays - 1))
+        return self
+
+    def statistics(self):
+        return self.accumulator.statistics()
+
+    def basicSafetyStock(self, safetyDays, leadTime):
+        return _basicSafetyStockFrame(self.statistics(), safetyDays, leadTime)
+
+    def safetyStockwtServiceRate(self, serviceRate, leadTimeInDays):
+        return _serviceRateSafetyStockFrame(self.statistics(), serviceRate, leadTimeInDays)
+
+    def save(self, path):
+        pd.to_pickle(self, path)
+
+    @classmethod
+    def load(cls, path):
+        return pd.read_pickle(path)
 
 
 def safetyStockwtServiceRate(file, productNumber, serviceRate, leadTimeInDays):
-    sales = prep_dataframe(file)
-    sales = sales.loc[sales['product_number'] == productNumber]
+    from scipy.stats import norm
+    sales = _as_dataset(file).product(productNumber)
     sales_qty = sales.set_index(["date"])
     sales_qty = sales_qty.reset_index()
     sales_qty = sales_qty[['quantity']]
@@ -235,41 +692,38 @@ def safetyStockwtServiceRate(file, productNumber, serviceRate, leadTimeInDays):
     print("Reorder Point: " + str(reorder_point))
 
 
-def safetyStockwtServiceRateList(file, serviceRate, leadTimeInDays):
-    sales = prep_dataframe(file)
-    result = pd.DataFrame(columns=['product_number', 'product_name', 'safety_stock', 'reorder_point'])
-    for pnum in sales.product_number.unique():
-        sales_prep = sales.loc[sales['product_number'] == pnum]
-        sales_qty = sales_prep.set_index(["date"])
-        sales_qty = sales_qty.reset_index()
-        sales_qty = sales_qty[['quantity']]
-        avg_sales = sales_qty.quantity.mean()
-        std = sales_qty.quantity.std()
-        servZ = norm.ppf(serviceRate)
-        LT_sqrt = math.sqrt(leadTimeInDays / 30)
-        safety_stock = servZ * std * LT_sqrt
-        reorder_point = safety_stock + avg_sales * leadTimeInDays
-        result = result.append(
-            {'product_number': pnum, 'product_name': sales_prep['product_name'].iloc[0], 'safety_stock': safety_stock,
-             'reorder_point': reorder_point}, ignore_index=True)
+def safetyStockwtServiceRateList(file, serviceRate, leadTimeInDays, chunksize=None):
+    stats = productStatistics(file, chunksize)
+    result = _serviceRateSafetyStockFrame(stats, serviceRate, leadTimeInDays)
     result.to_csv('ServiceRateSafetyStock.csv')
     print("Saftey Stock with service rate method method", result, sep='\n')
+    return result
 
 
 def cvPerProduct(file, product_number):
-    sales = prep_dataframe(file)
-    sales = sales.loc[sales['product_number'] == product_number]
+    sales = _as_dataset(file).product(product_number)
     sales_qty = sales[['date', 'quantity']]
-    sales_qty = sales_qty.set_index(["date"])
-    sales_qty = sales_qty.resample('D').mean()
+    with instrument.span('suPy.resample', rule='D', rows=len(sales_qty)):
+        sales_qty = sales_qty.set_index(["date"])
+        sales_qty = sales_qty.resample('D').mean()
     cv = sales_qty.quantity.std() / sales_qty.quantity.mean()
     print('Coefficient of Variation')
     print(cv)
 
 
+def cvList(file, chunksize=None):
+    stats = productStatistics(file, chunksize)
+    result = stats[['product_number', 'product_name', 'cv']]
+    result.to_csv('cvList.csv')
+    print("Coefficient of Variation", result, sep='\n')
+    return result
+
+
 def linearRegressionPerProduct(file, product_number):
-    sales = prep_dataframe(file)
-    sales = sales.loc[sales['product_number'] == product_number]
+    from sklearn.model_selection import train_test_split
+    from sklearn.linear_model import LinearRegression
+    from sklearn import metrics
+    sales = _as_dataset(file).product(product_number)
     X = sales['quantity'].values.reshape(-1, 1)
     y = sales['price'].values.reshape(-1, 1)
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=0)
@@ -283,14 +737,88 @@ def linearRegressionPerProduct(file, product_number):
     print('Mean Absolute Error:', metrics.mean_absolute_error(y_test, y_pred))
     print('Mean Squared Error:', metrics.mean_squared_error(y_test, y_pred))
     print('Root Mean Squared Error:', np.sqrt(metrics.mean_squared_error(y_test, y_pred)))
-    plt.scatter(X_test, y_test, color='gray')
-    plt.plot(X_test, y_pred, color='red', linewidth=2)
-    plt.show()
+    if display.is_headless():
+        return
+    with instrument.span('suPy.plot', plot='scatter', rows=len(X_test)):
+        import matplotlib.pyplot as plt
+        plt.scatter(X_test, y_test, color='gray')
+        plt.plot(X_test, y_pred, color='red', linewidth=2)
+        plt.show()
+
+
+def _testRows(codes, test_size, random_state):
+    # Rows that train_test_split(test_size, random_state) puts in the test set when called per product.
+    # Products of the same size share one permutation, so it is drawn once per distinct size.
+    sizes = np.bincount(codes)
+    order = np.argsort(codes, kind='stable')
+    starts = np.cumsum(sizes) - sizes
+    position = np.empty(len(codes), dtype=np.int64)
+    position[order] = np.arange(len(codes)) - starts[codes[order]]
+
+    distinct = np.unique(sizes[sizes >= 2])
+    offsets = np.zeros(sizes.max() + 1 if len(sizes) else 1, dtype=np.int64)
+    offsets[distinct] = np.cumsum(distinct) - distinct
+    masks = np.zeros(int(distinct.sum()), dtype=bool)
+    for n in distinct:
+        n_test = math.ceil(test_size * n)
+        permutation = np.random.RandomState(random_state).permutation(n)
+        masks[offsets[n] + permutation[:n_test]] = True
+
+    row_sizes = sizes[codes]
+    is_test = np.zeros(len(codes), dtype=bool)
+    fitted = row_sizes >= 2
+    is_test[fitted] = masks[offsets[row_sizes[fitted]] + position[fitted]]
+    return fitted, is_test
+
+
+def linearRegressionList(file, test_size=0.2, random_state=0):
+    # Price on quantity regression for every product at once from grouped sums, with the same
+    # train/test split as linearRegressionPerProduct. Products with fewer than two rows are left as nan.
+    sales = _as_dataset(file).sales
+    sales = sales.loc[sales['product_number'].notna() & sales['quantity'].notna() & sales['price'].notna()]
+    codes, products = pd.factorize(sales['product_number'])
+    x = sales['quantity'].values.astype(float)
+    y = sales['price'].values.astype(float)
+    count = len(products)
+
+    fitted, is_test = _testRows(codes, test_size, random_state)
+    train = (fitted & ~is_test).astype(float)
+    test = is_test.astype(float)
+
+    n_train = np.bincount(codes, weights=train, minlength=count)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_x = np.bincount(codes, weights=train * x, minlength=count) / n_train
+        mean_y = np.bincount(codes, weights=train * y, minlength=count) / n_train
+        dx = x - mean_x[codes]
+        dy = y - mean_y[codes]
+        sxx = np.bincount(codes, weights=train * dx * dx, minlength=count)
+        sxy = np.bincount(codes, weights=train * dx * dy, minlength=count)
+        slope = np.where(sxx > 0, sxy / np.where(sxx > 0, sxx, 1), 0.0)
+        slope = np.where(n_train > 0, slope, np.nan)
+        intercept = mean_y - slope * mean_x
+
+        error = np.where(is_test, y - (intercept[codes] + slope[codes] * x), 0.0)
+        n_test = np.bincount(codes, weights=test, minlength=count)
+        mae = np.bincount(codes, weights=np.abs(error), minlength=count) / n_test
+        mse = np.bincount(codes, weights=error * error, minlength=count) / n_test
+
+    first_rows = np.zeros(count, dtype=np.int64)
+    first_rows[codes[::-1]] = np.arange(len(codes))[::-1]
+    return pd.DataFrame({
+        'product_number': np.asarray(products),
+        'product_name': sales['product_name'].values[first_rows],
+        'n_train': n_train.astype(np.int64),
+        'n_test': n_test.astype(np.int64),
+        'intercept': intercept,
+        'slope': slope,
+        'mean_absolute_error': mae,
+        'mean_squared_error': mse,
+        'root_mean_squared_error': np.sqrt(mse),
+    })
 
 
 def eoqPerProduct(file, product_number, setupCost, holdingCost):
-    sales = prep_dataframe(file)
-    sales = sales.loc[sales['product_number'] == product_number]
+    sales = _as_dataset(file).product(product_number)
     sales_qty = sales[['date', 'quantity']]
     sales_qty = sales_qty.set_index(["date"])
     sales_qty = sales_qty.resample('Y').sum()
@@ -299,22 +827,23 @@ def eoqPerProduct(file, product_number, setupCost, holdingCost):
     print('EOQ :', EOQ)
 
 
-def avgQtySoldList(file):
-    sales = prep_dataframe(file)
-    sales = sales.dropna()
+def eoqList(file, setupCost, holdingCost, chunksize=None):
+    stats = productStatistics(file, chunksize)
+    result = stats[['product_number', 'product_name']].copy()
+    result['EOQ'] = np.sqrt(2 * stats['qty_sold_by_year'] * setupCost / holdingCost)
+    result.to_csv('eoqList.csv')
+    print("EOQ", result, sep='\n')
+    return result
+
+
+def avgQtySoldList(file, chunksize=None):
+    stats = productStatistics(file, chunksize)
     pd.set_option('display.float_format', lambda x: '%.2f' % x)
-    result = pd.DataFrame(columns=['product_number', 'product_name', 'QTY Sold by Year'])
-    for pnum in sales.product_number.unique():
-        sales_prep = sales.loc[sales['product_number'] == pnum]
-        sales_qty = sales_prep[['date', 'quantity']]
-        sales_qty = sales_qty.set_index(["date"])
-        sales_qty = sales_qty.resample('Y').sum()
-        avg_qty = sales_qty.quantity.mean()
-        result = result.append(
-            {'product_number': pnum, 'product_name': sales_prep['product_name'].iloc[0], 'QTY Sold by Year': avg_qty},
-            ignore_index=True)
+    result = stats.loc[stats['qty_sold_by_year'].notna(), ['product_number', 'product_name', 'qty_sold_by_year']]
+    result = result.rename(columns={'qty_sold_by_year': 'QTY Sold by Year'}).reset_index(drop=True)
     result.to_csv('avgQtySoldList.csv')
     print("Average Quantity Sold Per Year", result, sep='\n')
+    return result
 
 
 # def purchasingMetricList(salesData,eoqCost,serviceRate):
@@ -341,9 +870,8 @@ def avgQtySoldList(file):
 #     print("Purchasing Metrics", result, sep='\n')
 
 def seasonalityIndexPerProduct(file, product_number, year):
-    sales = prep_dataframe(file)
+    sales = _as_dataset(file).product(product_number)
     sales['total_amount'] = sales['quantity'] * sales['price']
-    sales = sales.loc[sales['product_number'] == product_number]
     sales['year'] = pd.DatetimeIndex(sales['date']).year
     sales['month'] = pd.DatetimeIndex(sales['date']).month
     sales_amount = sales.set_index(["date"])
@@ -359,85 +887,267 @@ def seasonalityIndexPerProduct(file, product_number, year):
     print("Seasonality Index Per Product", seationality_index_year, sep='\n')
 
 
-def forecastQtyMonthlySales(file, product_number, months):
-    sales = prep_dataframe(file)
-    forecastDF = sales.loc[sales['product_number'] == product_number]
-    forecastDF['sales'] = forecastDF['price'] * forecastDF['quantity']
-    forecastDF = forecastDF[['date', 'sales']]
-    forecastDF['index'], forecastDF['month_year'] = pd.to_datetime(forecastDF['date']).dt.to_period(
-        'M'), pd.to_datetime(forecastDF['date']).dt.to_period('M')
-    forecastDF = forecastDF[['index', 'month_year', 'sales']]
-    forecastDF.set_index('index', inplace=True)
-    forecastDF = forecastDF.groupby('month_year', as_index=False).agg({"sales": "sum"})
-    forecastDF = forecastDF.rename(index=str, columns={"sales": "y", "month_year": "ds"})
-    forecastDF['ds'] = forecastDF.ds.values.astype('datetime64[M]')
-    bev_model = Prophet(interval_width=0.95)
-    bev_model.fit(forecastDF)
-    future_dates = bev_model.make_future_dataframe(periods=months, freq='M')
-    forecast = bev_model.predict(future_dates)
+def seasonalityIndexCube(file, average=False, asArray=False):
+    # Seasonality index of every product, year and month from one grouped aggregation.
+    # The tidy frame has one row per product, year and month with sales, as seasonalityIndexPerProduct.
+    # asArray returns (cube, product_numbers, years) with cube[product, year, month - 1]; months without
+    # sales in a year with sales are 0 and years without sales are nan.
+    # average gives the index averaged over the years of each product (one row per product and month,
+    # or a product x month array).
+    sales = _as_dataset(file).sales
+    sales = sales.loc[sales['date'].notna() & sales['product_number'].notna()]
+    amount = (sales['quantity'] * sales['price']).rename('total_amount')
+    keys = [sales['product_number'], sales['date'].dt.year.rename('year'), sales['date'].dt.month.rename('month')]
+    tidy = amount.groupby(keys, observed=True).sum().reset_index()
+    year_total = tidy.groupby(['product_number', 'year'], observed=True)['total_amount'].transform('sum')
+    tidy['seasonality_index'] = tidy['total_amount'] / year_total
+
+    if not average and not asArray:
+        return tidy
+
+    product_codes, products = pd.factorize(tidy['product_number'])
+    year_codes, years = pd.factorize(tidy['year'], sort=True)
+    cube = np.full((len(products), len(years), 12), np.nan)
+    has_sales = np.zeros((len(products), len(years)), dtype=bool)
+    has_sales[product_codes, year_codes] = True
+    cube[has_sales] = 0.0
+    cube[product_codes, year_codes, tidy['month'].values - 1] = tidy['seasonality_index'].values
+
+    if not average:
+        return cube, np.asarray(products), np.asarray(years)
+    averaged = np.nanmean(cube, axis=1)
+    if asArray:
+        return averaged, np.asarray(products)
+    return pd.DataFrame({
+        'product_number': np.repeat(np.asarray(products), 12),
+        'month': np.tile(np.arange(1, 13), len(products)),
+        'seasonality_index': averaged.ravel(),
+    })
+
+
+# Monthly aggregation of each forecast metric: total sales amount, average price and average cost
+FORECAST_METRICS = {'sales': 'sum', 'price': 'mean', 'cost': 'mean'}
+
+
+def _monthlySeries(sales, metric):
+    # Monthly ds/y series per product in the shape Prophet expects
+    with instrument.span('suPy.resample', rule='M', rows=len(sales)):
+        sales = sales.loc[sales['date'].notna()]
+        if metric == 'sales':
+            values = sales['price'] * sales['quantity']
+        else:
+            values = sales[metric]
+        keys = [sales['product_number'], sales['date'].dt.to_period('M').rename('ds')]
+        series = values.groupby(keys, observed=True).agg(FORECAST_METRICS[metric]).rename('y').reset_index()
+        series['ds'] = series['ds'].dt.to_timestamp()
+    return series
+
+
+def _prophetForecast(series, months):
+    with instrument.span('suPy.prophet_fit', rows=len(series)):
+        from fbprophet import Prophet
+        model = Prophet(interval_width=0.95)
+        model.fit(series[['ds', 'y']])
+        future_dates = model.make_future_dataframe(periods=months, freq='M')
+        forecast = model.predict(future_dates)
+    return model, forecast
+
+
+# Smoothing parameters (alpha, beta, gamma) tried for every series by the Holt-Winters engine
+HOLT_WINTERS_GRID = [(alpha, beta, gamma)
+                     for alpha in (0.1, 0.3, 0.5, 0.8)
+                     for beta in (0.01, 0.1, 0.3)
+                     for gamma in (0.05, 0.2, 0.5)]
+
+
+def _holtWinters(Y, months, seasonLength=12):
+    # Additive Holt-Winters for a matrix of aligned series (one row per series, no missing values).
+    # Every parameter set of HOLT_WINTERS_GRID is run for all series at once and the set with the
+    # smallest one-step-ahead squared error is kept per series.
+    # Returns the point forecasts (series x months) and the residual standard deviation per series.
+    n, T = Y.shape
+    seasonal = T >= 2 * seasonLength
+    m = seasonLength if seasonal else 1
+    grid = np.array(HOLT_WINTERS_GRID if seasonal else sorted({(a, b, 0.0) for a, b, _ in HOLT_WINTERS_GRID}))
+    alpha, beta, gamma = (grid[:, i][:, None] for i in range(3))
+
+    if seasonal:
+        # Level and trend from the means of the first two seasons, seasonal indices from the first two
+        # seasons with that trend removed. The level is set one month before the first, so the first
+        # one-step forecast is level + trend + season.
+        first = Y[:, :m].mean(axis=1)
+        trend = (Y[:, m:2 * m].mean(axis=1) - first) / m
+        offset = np.arange(2 * m) - (m - 1) / 2
+        detrended = Y[:, :2 * m] - first[:, None] - trend[:, None] * offset
+        season = detrended.reshape(n, 2, m).mean(axis=1)
+        season -= season.mean(axis=1, keepdims=True)
+        level = first - (m + 1) / 2 * trend
+    else:
+        level = Y[:, 0]
+        trend = Y[:, 1] - Y[:, 0] if T > 1 else np.zeros(n)
+        season = np.zeros((n, 1))
+    level = np.tile(level, (len(grid), 1))
+    trend = np.tile(trend, (len(grid), 1))
+    season = np.tile(season, (len(grid), 1, 1))
+    sse = np.zeros((len(grid), n))
+
+    for t in range(T):
+        y = Y[:, t]
+        s = season[:, :, t % m]
+        sse += (y - (level + trend + s)) ** 2
+        new_level = alpha * (y - s) + (1 - alpha) * (level + trend)
+        trend = beta * (new_level - level) + (1 - beta) * trend
+        season[:, :, t % m] = gamma * (y - new_level) + (1 - gamma) * s
+        level = new_level
+
+    best = sse.argmin(axis=0)
+    rows = np.arange(n)
+    horizon = np.arange(1, months + 1)
+    slots = (T - 1 + horizon) % m
+    yhat = level[best, rows][:, None] + horizon * trend[best, rows][:, None] + season[best, rows][:, slots]
+    sigma = np.sqrt(sse[best, rows] / T)
+    return yhat, sigma
+
+
+def _holtWintersForecast(series, months, metric, interval_width=0.95, blockSize=5000):
+    # Holt-Winters forecasts for every product of a _monthlySeries frame, in the layout of the Prophet path:
+    # future months are labelled with month end dates and the interval widens with the horizon.
+    series = series.loc[series['y'].notna()]
+    ordinal = series['ds'].values.astype('datetime64[M]').astype(np.int64)
+    codes, products = pd.factorize(series['product_number'])
+    first = np.full(len(products), np.iinfo(np.int64).max)
+    np.minimum.at(first, codes, ordinal)
+    last = np.full(len(products), np.iinfo(np.int64).min)
+    np.maximum.at(last, codes, ordinal)
+    observed = np.bincount(codes, minlength=len(products))
+    length = last - first + 1
+
+    from scipy.stats import norm
+    z = norm.ppf(0.5 + interval_width / 2)
+    horizon = np.arange(1, months + 1)
+    forecasts = []
+    for T in np.unique(length[observed >= 2]):
+        group = np.flatnonzero((length == T) & (observed >= 2))
+        position = np.full(len(products), -1)
+        position[group] = np.arange(len(group))
+        rows = position[codes]
+        keep = rows >= 0
+        Y = np.full((len(group), T), np.nan)
+        Y[rows[keep], ordinal[keep] - first[codes[keep]]] = series['y'].values[keep]
+        # Months without rows had no sales; missing prices and costs carry the previous month forward
+        if metric == 'sales':
+            Y = np.nan_to_num(Y)
+        else:
+            Y = pd.DataFrame(Y).ffill(axis=1).values
+
+        for start in range(0, len(group), blockSize):
+            block = group[start:start + blockSize]
+            with instrument.span('suPy.holtwinters_fit', rows=len(block) * int(T)):
+                yhat, sigma = _holtWinters(Y[start:start + blockSize], months)
+            width = z * sigma[:, None] * np.sqrt(horizon)
+            month_end = (last[block][:, None] + horizon).astype('datetime64[M]').astype('datetime64[D]') - 1
+            forecasts.append(pd.DataFrame({
+                'product_number': np.repeat(products[block], months),
+                'ds': month_end.ravel().astype('datetime64[ns]'),
+                'yhat': yhat.ravel(),
+                'yhat_lower': (yhat - width).ravel(),
+                'yhat_upper': (yhat + width).ravel(),
+            }))
+
+    if not forecasts:
+        return pd.DataFrame(columns=['product_number', 'ds', 'yhat', 'yhat_lower', 'yhat_upper'])
+    return pd.concat(forecasts, ignore_index=True)
+
+
+def _printForecast(file, product_number, metric, months, engine):
+    series = _monthlySeries(_as_dataset(file).product(product_number), metric)
+    if engine == 'holtwinters':
+        forecast = _holtWintersForecast(series, months, metric)
+        print('Forecast Metrics: ')
+        print(forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']])
+        if display.is_headless():
+            return
+        with instrument.span('suPy.plot', plot='forecast', rows=len(series)):
+            import matplotlib.pyplot as plt
+            print('Forecast Graph: ')
+            plt.figure(figsize=(20, 9))
+            plt.plot(series['ds'], series['y'], 'k.')
+            plt.plot(forecast['ds'], forecast['yhat'])
+            plt.fill_between(forecast['ds'], forecast['yhat_lower'], forecast['yhat_upper'], alpha=0.2)
+        return
+    model, forecast = _prophetForecast(series, months)
     print('Forecast Metrics: ')
     print(forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].tail(months))
+    if display.is_headless():
+        return
     print('Forecast Graph: ')
-    bev_model.plot(forecast, uncertainty=True);
-
-
-def forecastMonthlyPrice(file, product_number, months):
-    sales = prep_dataframe(file)
-    forecastDF = sales.loc[sales['product_number'] == product_number]
-    forecastDF = forecastDF[['date', 'price']]
-    forecastDF['index'], forecastDF['month_year'] = pd.to_datetime(forecastDF['date']).dt.to_period(
-        'M'), pd.to_datetime(forecastDF['date']).dt.to_period('M')
-    forecastDF = forecastDF[['index', 'month_year', 'price']]
-    forecastDF.set_index('index', inplace=True)
-    forecastDF = forecastDF.groupby('month_year', as_index=False).agg({"price": "mean"})
-    forecastDF = forecastDF.rename(index=str, columns={"price": "y", "month_year": "ds"})
-    forecastDF['ds'] = forecastDF.ds.values.astype('datetime64[M]')
-    bev_model = Prophet(interval_width=0.95)
-    bev_model.fit(forecastDF)
-    future_dates = bev_model.make_future_dataframe(periods=months, freq='M')
-    forecast = bev_model.predict(future_dates)
-    print('Forecast Metrics: ')
-    print(forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].tail(months))
-    print('Forecast Graph: ')
-    bev_model.plot(forecast, uncertainty=True)
-
-
-def forecastMonthlyCost(file, product_number, months):
-    sales = prep_dataframe(file)
-    forecastDF = sales.loc[sales['product_number'] == product_number]
-    forecastDF = forecastDF[['date', 'cost']]
-    forecastDF['index'], forecastDF['month_year'] = pd.to_datetime(forecastDF['date']).dt.to_period(
-        'M'), pd.to_datetime(forecastDF['date']).dt.to_period('M')
-    forecastDF = forecastDF[['index', 'month_year', 'cost']]
-    forecastDF.set_index('index', inplace=True)
-    forecastDF = forecastDF.groupby('month_year', as_index=False).agg({"cost": "mean"})
-    forecastDF = forecastDF.rename(index=str, columns={"cost": "y", "month_year": "ds"})
-    forecastDF['ds'] = forecastDF.ds.values.astype('datetime64[M]')
-    bev_model = Prophet(interval_width=0.95)
-    bev_model.fit(forecastDF)
-    future_dates = bev_model.make_future_dataframe(periods=months, freq='M')
-    forecast = bev_model.predict(future_dates)
-    print('Forecast Metrics: ')
-    print(forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].tail(months))
-    print('Forecast Graph: ')
-    bev_model.plot(forecast, uncertainty=True)
-
-
-def anomaly_detection(file, target_col, target_sku):
-    sales = prep_dataframe(file)
-    sales = sales.loc[df['product_number'] == target_sku]
-    sales = sales[['date', target_col]]
-    sales = sales.set_index('date').groupby(pd.Grouper(freq='D')).max()
-    sales = sales.reset_index()
-    sales = sales.dropna()
-    sales.columns = ['ds', 'y']
-    pred = _fit_predict_model(sales)
-    pred = _detect_anomalies(pred)
-    pred_ano = pred.loc[pred['anomaly'] == 1]
-
-    fig = go.Figure()
-    fig.add_trace(go.Scatter(x=pred['ds'], y=pred['fact'], name=target_col, mode='lines'))
-    fig.add_trace(
-        go.Scatter(x=pred_ano['ds'], y=pred_ano['fact'], mode='markers', name='Anomaly', marker=dict(color='red')))
-    fig.update_layout(showlegend=True, title='Detected Anomalies')
-    fig.show()
\ No newline at end of file
+    with instrument.span('suPy.plot', plot='forecast', rows=len(series)):
+        model.plot(forecast, uncertainty=True)
+
+
+def _checkEngine(engine):
+    if engine not in ('prophet', 'holtwinters'):
+        raise ValueError("engine must be 'prophet' or 'holtwinters'")
+
+
+def forecastQtyMonthlySales(file, product_number, months, engine='prophet'):
+    _checkEngine(engine)
+    _printForecast(file, product_number, 'sales', months, engine)
+
+
+def forecastMonthlyPrice(file, product_number, months, engine='prophet'):
+    _checkEngine(engine)
+    _printForecast(file, product_number, 'price', months, engine)
+
+
+def forecastMonthlyCost(file, product_number, months, engine='prophet'):
+    _checkEngine(engine)
+    _printForecast(file, product_number, 'cost', months, engine)
+
+
+def _forecastWorker(task):
+    product_number, series, months = task
+    _, forecast = _prophetForecast(series, months)
+    forecast = forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].tail(months)
+    forecast.insert(0, 'product_number', product_number)
+    return forecast
+
+
+def forecastBatch(file, product_numbers, metric, months, processes=None, engine='prophet'):
+    # Forecast a metric (sales, price or cost) for a list of product numbers or "all" products.
+    # With the prophet engine one model is fitted per product over a pool of processes (processes=1 runs
+    # in-process); the holtwinters engine fits all products together as matrix operations in this process.
+    # The forecasted months are returned in long format; nothing is printed or plotted.
+    # Products with fewer than two months of history cannot be fitted and are left out.
+    _checkEngine(engine)
+    if metric not in FORECAST_METRICS:
+        raise ValueError("metric must be one of: " + ", ".join(FORECAST_METRICS))
+    series = _monthlySeries(_as_dataset(file).sales, metric)
+    if not (isinstance(product_numbers, str) and product_numbers == 'all'):
+        series = series.loc[series['product_number'].isin(product_numbers)]
+    if engine == 'holtwinters':
+        return _holtWintersForecast(series, months, metric)
+
+    tasks = []
+    for pnum, group in series.groupby('product_number', observed=True, sort=False):
+        if group['y'].notna().sum() >= 2:
+            tasks.append((pnum, group[['ds', 'y']].reset_index(drop=True), months))
+
+    if processes == 1:
+        forecasts = [_forecastWorker(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            workers = processes or os.cpu_count() or 1
+            chunksize = max(1, len(tasks) // (workers * 4))
+            forecasts = list(executor.map(_forecastWorker, tasks, chunksize=chunksize))
+
+    if not forecasts:
+        return pd.DataFrame(columns=['product_number', 'ds', 'yhat', 'yhat_lower', 'yhat_upper'])
+    return pd.concat(forecasts, ignore_index=True)
+
+
+def anomaly_detection(file, target_col, target_sku, engine='prophet'):
+    # Anomalies in the daily maximum of target_col for one product, found and plotted by
+    # statsPy.anomalies_detection; engine='mad' uses rolling median/MAD bands instead of Prophet
+    sales = _as_dataset(file).product(target_sku)
+    return statsPy.anomalies_detection(sales, 'product_number', target_sku, target_col, engine=engine)
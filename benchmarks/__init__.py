@@ -0,0 +1 @@
+# Benchmark scenarios and seeded synthetic data generators, see run.py
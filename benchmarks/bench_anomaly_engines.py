@@ -0,0 +1,56 @@
+# Speed and detection quality of the rolling median/MAD anomaly engine against Prophet.
+# Synthetic daily series get a few injected spikes; precision and recall are measured on those.
+# Prophet is skipped when fbprophet is not installed.
+#
+#   python benchmarks/bench_anomaly_engines.py --series 500 --prophet-series 10
+
+import argparse
+import importlib.util
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from GusPI import statsPy  # noqa: E402
+from benchmarks import generators  # noqa: E402
+
+
+def score(pred, injected):
+    flagged = pred['anomaly'].values == 1
+    true_positive = (flagged & injected).sum()
+    precision = true_positive / max(flagged.sum(), 1)
+    recall = true_positive / max(injected.sum(), 1)
+    return precision, recall
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--series', type=int, default=1000)
+    parser.add_argument('--prophet-series', type=int, default=10)
+    parser.add_argument('--days', type=int, default=365)
+    args = parser.parse_args()
+
+    frame, injected = generators.daily_series(args.series, args.days)
+
+    start = time.perf_counter()
+    mad = statsPy.anomalies_detection_batch(frame, 'account', 'amount', engine='mad')
+    mad_time = time.perf_counter() - start
+    print('mad    : %d series in %.3fs (%.2f ms/series), precision %.3f recall %.3f'
+          % ((args.series, mad_time, 1000 * mad_time / args.series) + score(mad, injected)))
+
+    if args.prophet_series <= 0:
+        return
+    if importlib.util.find_spec('fbprophet') is None:
+        print('prophet: skipped, fbprophet is not installed')
+        return
+    subset = frame['account'] < args.prophet_series
+    start = time.perf_counter()
+    prophet = statsPy.anomalies_detection_batch(frame.loc[subset], 'account', 'amount', processes=1)
+    prophet_time = time.perf_counter() - start
+    print('prophet: %d series in %.3fs (%.2f ms/series), precision %.3f recall %.3f'
+          % ((args.prophet_series, prophet_time, 1000 * prophet_time / args.prophet_series)
+             + score(prophet, injected[subset.values])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# Accuracy and speed of the Holt-Winters forecast engine against Prophet and a seasonal-naive forecast
+# with drift on synthetic monthly series. The last 12 months of every series are held out and every
+# method forecasts them from the rest. Prophet is skipped when fbprophet is not installed.
+#
+#   python benchmarks/bench_forecast_engines.py --series 200 --prophet-series 50
+
+import argparse
+import importlib.util
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from GusPI import suPy  # noqa: E402
+from benchmarks import generators  # noqa: E402
+
+
+def mape(forecast, actual):
+    merged = forecast.assign(h=forecast.groupby('product_number').cumcount()).merge(
+        actual.assign(h=actual.groupby('product_number').cumcount()), on=['product_number', 'h'])
+    return float(np.mean(np.abs(merged['yhat'] - merged['y']) / np.abs(merged['y'])))
+
+
+def seasonal_naive(history, months, seasonLength=12):
+    # Value of the same month one season earlier plus the average monthly change of the series
+    Y = np.stack(history.groupby('product_number', sort=False)['y'].apply(np.asarray).values)
+    T = Y.shape[1]
+    drift = (Y[:, -1] - Y[:, 0]) / (T - 1)
+    horizon = np.arange(1, months + 1)
+    seasons = np.ceil(horizon / seasonLength)
+    yhat = Y[:, T - seasonLength + (horizon - 1) % seasonLength] + seasons * seasonLength * drift[:, None]
+    return pd.DataFrame({'product_number': np.repeat(history['product_number'].unique(), months),
+                         'yhat': yhat.ravel()})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--series', type=int, default=2000)
+    parser.add_argument('--prophet-series', type=int, default=50)
+    parser.add_argument('--months', type=int, default=60)
+    args = parser.parse_args()
+
+    holdout = 12
+    data = generators.monthly_series(args.series, args.months)
+    history = data.groupby('product_number').head(args.months - holdout)
+    actual = data.groupby('product_number').tail(holdout)
+
+    start = time.perf_counter()
+    hw = suPy._holtWintersForecast(history, holdout, 'sales')
+    hw_time = time.perf_counter() - start
+    print('holtwinters: %d series in %.3fs (%.2f ms/series), MAPE %.4f'
+          % (args.series, hw_time, 1000 * hw_time / args.series, mape(hw, actual)))
+    print('seasonal naive with drift: MAPE %.4f' % mape(seasonal_naive(history, holdout), actual))
+
+    if args.prophet_series <= 0:
+        return
+    if importlib.util.find_spec('fbprophet') is None:
+        print('prophet    : skipped, fbprophet is not installed')
+        return
+    products = history['product_number'].unique()[:args.prophet_series]
+    start = time.perf_counter()
+    prophet = [suPy._forecastWorker((pnum, history.loc[history['product_number'] == pnum, ['ds', 'y']], holdout))
+               for pnum in products]
+    prophet_time = time.perf_counter() - start
+    prophet = pd.concat(prophet, ignore_index=True)
+    hw_subset = hw.loc[hw['product_number'].isin(products)]
+    actual_subset = actual.loc[actual['product_number'].isin(products)]
+    print('prophet    : %d series in %.3fs (%.2f ms/series), MAPE %.4f'
+          % (len(products), prophet_time, 1000 * prophet_time / len(products), mape(prophet, actual_subset)))
+    print('holtwinters on the same %d series: MAPE %.4f' % (len(products), mape(hw_subset, actual_subset)))
+
+
+if __name__ == '__main__':
+    main()
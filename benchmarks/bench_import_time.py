@@ -0,0 +1,56 @@
+# Import time regression check for compute-only use of GusPI.
+# Importing suPy, statsPy and finPy must not pull in the plotting, modelling or data download
+# libraries, and must stay under a time budget. Exits with status 1 on a regression.
+#
+#   python benchmarks/bench_import_time.py --budget 2.0
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HEAVY_MODULES = ['matplotlib', 'seaborn', 'plotly', 'scipy', 'sklearn', 'fbprophet', 'prophet', 'simfin']
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+from GusPI import suPy, statsPy, finPy
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'modules': sorted(m for m in sys.modules if '.' not in m)}))
+'''
+
+
+def measure(repeat):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', PROBE], env=env, check=True, capture_output=True, text=True)
+        runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    return runs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', type=float, default=2.0, help='maximum seconds for the cold import')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    runs = measure(args.repeat)
+    best = min(run['seconds'] for run in runs)
+    loaded = sorted(set(HEAVY_MODULES) & set(runs[0]['modules']))
+    print('import GusPI.suPy, statsPy, finPy: best of %d %.3fs (budget %.3fs)' % (args.repeat, best, args.budget))
+
+    failed = False
+    if loaded:
+        print('heavy modules imported at load time: ' + ', '.join(loaded))
+        failed = True
+    if best > args.budget:
+        print('import time over budget')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
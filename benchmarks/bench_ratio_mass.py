@@ -0,0 +1,54 @@
+# Compare the panel engine of calculate_ratio_mass with the per-symbol loop on synthetic SimFin panels.
+# The loop is timed on a subset of tickers and both engines are checked to give the same ratios there.
+#
+#   python benchmarks/bench_ratio_mass.py --companies 5000 --loop-companies 200
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from GusPI import finPy  # noqa: E402
+from benchmarks import generators  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--companies', type=int, default=5000)
+    parser.add_argument('--loop-companies', type=int, default=200)
+    parser.add_argument('--years', type=int, default=10)
+    args = parser.parse_args()
+
+    income, balance = generators.statement_panels(args.companies, args.years)
+    panels = {'income': income, 'balance': balance}
+    finPy._load_simfin = lambda dataset, variant, country, columns=None: panels[dataset]
+    tickers = list(income.index.get_level_values(0).unique())
+    # Load the store first so both engines are timed on the ratios only
+    finPy.get_market_data('income', 'us')
+    finPy.get_market_data('balance', 'us')
+
+    subset = tickers[:args.loop_companies]
+    start = time.perf_counter()
+    loop = finPy.calculate_ratio_mass(subset, engine='loop')
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    panel = finPy.calculate_ratio_mass(tickers)
+    panel_time = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(panel.loc[subset], loop, check_dtype=False)
+    per_loop = loop_time / len(subset)
+    print('companies=%d years=%d' % (args.companies, args.years))
+    print('per-symbol loop : %.3fs for %d companies (%.2f ms/company, ~%.1fs for all)'
+          % (loop_time, len(subset), 1000 * per_loop, per_loop * len(tickers)))
+    print('panel engine    : %.3fs for %d companies (%.0fx per company)'
+          % (panel_time, len(tickers), per_loop * len(tickers) / panel_time))
+    print('ratios          : %d rows, %d non-finite' % (len(panel), (~np.isfinite(panel.values)).sum()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# SafetyStockCalculator with windowDays, fed one delta file at a time, against a calculator built from
+# only the rows inside the window. Checks the evicted statistics match and times both.
+#
+#   python benchmarks/bench_safety_stock_window.py --rows 200000 --products 500 --windows 45 100 400
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from GusPI import suPy  # noqa: E402
+from benchmarks import generators  # noqa: E402
+
+COLUMNS = ['count', 'avg_qty', 'std_qty', 'qty_sold_by_year', 'cv']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--delta-days', type=int, default=30)
+    parser.add_argument('--windows', type=int, nargs='+', default=[45, 100, 400])
+    args = parser.parse_args()
+
+    sales = generators.sales_frame(args.rows, args.products)
+    period = (sales['date'] - sales['date'].min()).dt.days // args.delta_days
+    deltas = [delta for _, delta in sales.groupby(period, sort=True)]
+    latest = sales['date'].max()
+    print('rows=%d products=%d deltas=%d' % (args.rows, args.products, len(deltas)))
+
+    for window in args.windows:
+        start = time.perf_counter()
+        calculator = suPy.SafetyStockCalculator(windowDays=window)
+        for delta in deltas:
+            calculator.update(delta)
+        incremental_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        windowed = sales.loc[sales['date'] >= latest - pd.Timedelta(days=window - 1)]
+        fresh = suPy.SafetyStockCalculator().update(windowed)
+        fresh_time = time.perf_counter() - start
+
+        evicted = calculator.statistics().set_index('product_number').sort_index()
+        expected = fresh.statistics().set_index('product_number').sort_index()
+        assert list(evicted.index) == list(expected.index)
+        np.testing.assert_allclose(evicted[COLUMNS].to_numpy(float), expected[COLUMNS].to_numpy(float),
+                                   rtol=1e-9, equal_nan=True)
+        print('windowDays=%-4d incremental %.3fs, fresh window %.3fs, statistics match'
+              % (window, incremental_time, fresh_time))
+
+
+if __name__ == '__main__':
+    main()
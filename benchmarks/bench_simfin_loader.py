@@ -0,0 +1,62 @@
+# Load time and in-memory size of a SimFin bulk csv file: parsed as simfin does, against the columnar copy
+# read by finPy.load_local_dataset with only the columns calculateMetrics needs.
+#
+#   python benchmarks/bench_simfin_loader.py --companies 20000
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from GusPI import finPy  # noqa: E402
+from benchmarks import generators  # noqa: E402
+
+
+def measure(run):
+    start = time.perf_counter()
+    result = run()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--companies', type=int, default=20000)
+    parser.add_argument('--years', type=int, default=10)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='guspi_simfin_')
+    income, _ = generators.statement_panels(args.companies, args.years)
+    csv_path = os.path.join(directory, 'us-income-annual.csv')
+    income.reset_index().to_csv(csv_path, sep=';', index=False)
+
+    def simfin_parse():
+        # What simfin.load_income does with a file on disk
+        df = pd.read_csv(csv_path, sep=';', parse_dates=finPy.SIMFIN_DATES)
+        return df.set_index(['Ticker', 'Report Date']).sort_index()
+
+    finPy.use_local_data(directory)
+
+    def columns():
+        # Read from the schema of the columnar copy, so the first call converts the csv file
+        return finPy.ratio_columns('income')
+
+    rows = [('simfin csv parse', simfin_parse),
+            ('first load (convert)', lambda: finPy.load_local_dataset('income', directory=directory,
+                                                                      columns=columns())),
+            ('columnar, projected', lambda: finPy.load_local_dataset('income', directory=directory,
+                                                                     columns=columns())),
+            ('columnar, all columns', lambda: finPy.load_local_dataset('income', directory=directory))]
+
+    print('rows=%d csv=%.1f MB' % (len(income), os.path.getsize(csv_path) / 2 ** 20))
+    for name, run in rows:
+        df, seconds = measure(run)
+        print('%-22s %8.3fs %8.1f MB in memory, %d columns'
+              % (name, seconds, df.memory_usage(deep=True).sum() / 2 ** 20, df.shape[1]))
+
+
+if __name__ == '__main__':
+    main()
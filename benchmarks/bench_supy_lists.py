@@ -0,0 +1,61 @@
+# Compare the grouped productStatistics engine with the per-product loop it replaced.
+#
+#   python benchmarks/bench_supy_lists.py --rows 200000 --products 5000
+
+import argparse
+import math
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from GusPI import suPy  # noqa: E402
+from benchmarks import generators  # noqa: E402
+
+
+def legacy_service_rate_list(sales, serviceRate, leadTimeInDays):
+    # The loop safetyStockwtServiceRateList used before productStatistics
+    rows = []
+    for pnum in sales.product_number.unique():
+        sales_prep = sales.loc[sales['product_number'] == pnum]
+        avg_sales = sales_prep.quantity.mean()
+        std = sales_prep.quantity.std()
+        safety_stock = norm.ppf(serviceRate) * std * math.sqrt(leadTimeInDays / 30)
+        reorder_point = safety_stock + avg_sales * leadTimeInDays
+        rows.append({'product_number': pnum, 'product_name': sales_prep['product_name'].iloc[0],
+                     'safety_stock': safety_stock, 'reorder_point': reorder_point})
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--products', type=int, default=2000)
+    args = parser.parse_args()
+
+    sales = generators.sales_frame(args.rows, args.products)
+
+    start = time.perf_counter()
+    legacy = legacy_service_rate_list(sales, 0.95, 7)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    stats = suPy.productStatistics(suPy.SalesDataset(sales))
+    grouped = suPy._serviceRateSafetyStockFrame(stats, 0.95, 7)
+    grouped_time = time.perf_counter() - start
+
+    legacy = legacy.set_index(legacy['product_number'].astype(str))
+    grouped = grouped.set_index(grouped['product_number'].astype(str)).loc[legacy.index]
+    np.testing.assert_allclose(grouped['reorder_point'].values, legacy['reorder_point'].values, rtol=1e-9)
+
+    print('rows=%d products=%d' % (args.rows, args.products))
+    print('per-product loop : %.3fs' % legacy_time)
+    print('grouped engine   : %.3fs (%.1fx)' % (grouped_time, legacy_time / grouped_time))
+
+
+if __name__ == '__main__':
+    main()
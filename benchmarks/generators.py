@@ -0,0 +1,204 @@
+# Seeded synthetic data shaped like the templates in sampleFiles/.
+# Every generator yields dataframes of at most chunksize rows, so files from 10k up to 100M rows
+# can be written without holding them in memory. The output is fixed for a given seed and chunksize.
+
+import os
+
+import numpy as np
+import pandas as pd
+
+SIZES = {'10k': 10000, '100k': 100000, '1m': 1000000, '10m': 10000000, '100m': 100000000}
+
+GL_ACCOUNTS = [
+    (10200, 'Cash on hand', 'AS'), (10400, 'Accounts receivable', 'AS'), (12000, 'Inventory', 'AS'),
+    (15000, 'Equipment', 'AS'), (20000, 'Accounts payable', 'LI'), (23000, 'Accrued expenses', 'LI'),
+    (27000, 'Long term debt', 'LI'), (39000, 'Retained earnings', 'EQ'), (40000, 'Sales', 'RE'),
+    (41000, 'Service revenue', 'RE'), (50000, 'Cost of goods sold', 'EX'), (60000, 'Salaries', 'EX'),
+    (64000, 'Rent', 'EX'), (67000, 'Utilities', 'EX'), (70000, 'Interest expense', 'EX'),
+]
+
+# Line items in SimFin naming, as returned by simfin.load_income and simfin.load_balance
+INCOME_ITEMS = [
+    'Revenue', 'Cost of Revenue', 'Gross Profit', 'Operating Expenses', 'Selling, General & Administrative',
+    'Research & Development', 'Depreciation & Amortization', 'Operating Income (Loss)',
+    'Non-Operating Income (Loss)', 'Interest Expense, Net', 'Pretax Income (Loss), Adj.',
+    'Abnormal Gains (Losses)', 'Pretax Income (Loss)', 'Income Tax (Expense) Benefit, Net',
+    'Income (Loss) from Continuing Operations', 'Net Extraordinary Gains (Losses)', 'Net Income',
+    'Net Income (Common)',
+]
+BALANCE_ITEMS = [
+    'Cash, Cash Equivalents & Short Term Investments', 'Accounts & Notes Receivable', 'Inventories',
+    'Total Current Assets', 'Property, Plant & Equipment, Net', 'Long Term Investments & Receivables',
+    'Other Long Term Assets', 'Total Noncurrent Assets', 'Total Assets', 'Payables & Accruals',
+    'Short Term Debt', 'Total Current Liabilities', 'Long Term Debt', 'Total Noncurrent Liabilities',
+    'Total Liabilities', 'Share Capital & Additional Paid-In Capital', 'Treasury Stock', 'Retained Earnings',
+    'Total Equity', 'Total Liabilities & Equity',
+]
+
+
+def _chunk_sizes(rows, chunksize):
+    for start in range(0, rows, chunksize):
+        yield min(chunksize, rows - start)
+
+
+def sales_chunks(rows, products=None, chunksize=1000000, seed=0, years=5):
+    # SalesData.csv: ref, date, product_number, product_name, quantity, price, cost
+    products = products or max(1, min(rows // 100, 100000))
+    rng = np.random.default_rng(seed)
+    numbers = ['P%06d' % i for i in range(products)]
+    names = ['Product %d' % i for i in range(products)]
+    list_price = rng.uniform(5, 50, products).round(2)
+    unit_cost = (list_price * rng.uniform(0.3, 0.8, products)).round(2)
+    ref = 0
+    for size in _chunk_sizes(rows, chunksize):
+        ids = rng.integers(0, products, size)
+        yield pd.DataFrame({
+            'ref': np.arange(ref, ref + size),
+            'date': pd.Timestamp('2015-01-01') + pd.to_timedelta(rng.integers(0, years * 365, size), unit='D'),
+            'product_number': pd.Categorical.from_codes(ids, numbers),
+            'product_name': pd.Categorical.from_codes(ids, names),
+            'quantity': rng.poisson(20, size).astype(float),
+            'price': (list_price[ids] * rng.uniform(0.9, 1.1, size)).round(2),
+            'cost': unit_cost[ids],
+        })
+        ref += size
+
+
+def sales_frame(rows, products=None, seed=0):
+    # In memory and typed the way suPy.prep_dataframe leaves a parsed file
+    sales = pd.concat(sales_chunks(rows, products, chunksize=rows or 1, seed=seed), ignore_index=True)
+    sales['ref'] = sales['ref'].astype('category')
+    return sales
+
+
+def gl_chunks(rows, chunksize=1000000, seed=0, days=5 * 365):
+    # GLAcct.csv: Date, GLACCT, DESC, GLTYPE, debit/credit/total amounts and running balances per account.
+    # Amounts are log-normal so their leading digits follow Benford's law.
+    rng = np.random.default_rng(seed)
+    accounts = np.array([account for account, _, _ in GL_ACCOUNTS])
+    descriptions = [desc for _, desc, _ in GL_ACCOUNTS]
+    types, type_codes = np.unique([gltype for _, _, gltype in GL_ACCOUNTS], return_inverse=True)
+    debit_side = np.isin(types[type_codes], ['AS', 'EX'])
+    balances = np.zeros((len(accounts), 3))
+    start = 0
+    for size in _chunk_sizes(rows, chunksize):
+        ids = rng.integers(0, len(accounts), size)
+        amount = rng.lognormal(6, 2, size).round(2)
+        is_debit = np.where(rng.random(size) < 0.8, debit_side[ids], ~debit_side[ids])
+        debit = np.where(is_debit, amount, 0.0)
+        credit = np.where(is_debit, 0.0, amount)
+        day = (np.arange(start, start + size) * days) // rows
+        movements = np.column_stack([debit, credit, debit - credit])
+        running = np.empty_like(movements)
+        for column in range(3):
+            running[:, column] = pd.Series(movements[:, column]).groupby(ids).cumsum().values
+        running += balances[ids]
+        np.add.at(balances, ids, movements)
+        yield pd.DataFrame({
+            'Date': (pd.Timestamp('2015-01-01') + pd.to_timedelta(day, unit='D')).strftime('%m/%d/%Y'),
+            'GLACCT': accounts[ids],
+            'DESC': pd.Categorical.from_codes(ids, descriptions),
+            'GLTYPE': pd.Categorical.from_codes(type_codes[ids], types),
+            'DebitAmount': debit,
+            'CreditAmount': credit,
+            'TotalAmount': movements[:, 2],
+            'DebitBalance': running[:, 0].round(2),
+            'CreditBalance': running[:, 1].round(2),
+            'TotalBalance': running[:, 2].round(2),
+        })
+        start += size
+
+
+def statement_panels(companies, years=10, seed=0):
+    # Annual income and balance panels shaped like simfin.load_income / load_balance,
+    # indexed by Ticker and Report Date with companies * years rows each
+    rng = np.random.default_rng(seed)
+    tickers = np.repeat(['T%05d' % i for i in range(companies)], years)
+    fiscal_year = np.tile(np.arange(2020 - years, 2020), companies)
+    report_date = pd.to_datetime(fiscal_year.astype(str) + '-12-31')
+    size = rng.lognormal(20, 1.5, companies).repeat(years) * np.tile(1.05 ** np.arange(years), companies)
+
+    def frame(items, scale):
+        data = pd.DataFrame({
+            'Ticker': tickers,
+            'Report Date': report_date,
+            'SimFinId': np.repeat(np.arange(companies), years),
+            'Currency': 'USD',
+            'Fiscal Year': fiscal_year,
+            'Fiscal Period': 'FY',
+            'Publish Date': report_date + pd.Timedelta(days=60),
+            'Restated Date': report_date + pd.Timedelta(days=425),
+            'Shares (Basic)': (size / 50).round(),
+            'Shares (Diluted)': (size / 48).round(),
+        })
+        values = size[:, None] * rng.uniform(0.05, 1.0, (len(size), len(items))) * scale
+        data = pd.concat([data, pd.DataFrame(values.round(), columns=items)], axis=1)
+        return data.set_index(['Ticker', 'Report Date'])
+
+    return frame(INCOME_ITEMS, 1.0), frame(BALANCE_ITEMS, 2.0)
+
+
+def statement_template(items, periods, seed=0):
+    # Breakdown rows by period columns, like sampleFiles/income_statement.csv and balancesheet.csv
+    rng = np.random.default_rng(seed)
+    columns = pd.date_range(end='2019-12-31', periods=periods, freq='YE').strftime('%m/%d/%y')[::-1]
+    values = rng.lognormal(18, 1, (len(items), periods)).round()
+    statement = pd.DataFrame(values, columns=columns)
+    statement.insert(0, 'Breakdown', [item.replace(' ', '_') for item in items])
+    return statement
+
+
+def monthly_series(series, months, seed=0):
+    # Trend plus yearly seasonality in the product_number, ds, y layout of suPy._monthlySeries
+    rng = np.random.default_rng(seed)
+    t = np.arange(months)
+    level = rng.uniform(1000, 5000, (series, 1))
+    growth = rng.normal(5, 5, (series, 1))
+    amplitude = rng.uniform(0, 0.3, (series, 1)) * level
+    noise = rng.normal(0, 0.05, (series, months)) * level
+    Y = level + growth * t + amplitude * np.sin(2 * np.pi * t / 12) + noise
+    ds = pd.date_range('2015-01-01', periods=months, freq='MS')
+    return pd.DataFrame({
+        'product_number': np.repeat(['P%05d' % i for i in range(series)], months),
+        'ds': np.tile(ds, series),
+        'y': Y.ravel(),
+    })
+
+
+def daily_series(series, days, spikes=5, seed=0):
+    # Weekly seasonal daily amounts per account with a few injected spikes; returns the frame
+    # and a boolean array marking the injected rows
+    rng = np.random.default_rng(seed)
+    t = np.arange(days)
+    level = rng.uniform(100, 1000, (series, 1))
+    Y = level * (1 + 0.1 * np.sin(2 * np.pi * t / 7)) + rng.normal(0, 0.05, (series, days)) * level
+    injected = np.zeros((series, days), dtype=bool)
+    for row in range(series):
+        injected[row, rng.choice(days, spikes, replace=False)] = True
+    Y = np.where(injected, Y * 3, Y)
+    frame = pd.DataFrame({
+        'account': np.repeat(np.arange(series), days),
+        'date': np.tile(pd.date_range('2019-01-01', periods=days, freq='D'), series),
+        'amount': Y.ravel(),
+    })
+    return frame, injected.ravel()
+
+
+def write_csv(path, chunks, **to_csv_args):
+    # Append chunks to a csv file through a temporary name, so an interrupted run leaves no partial file
+    temp_path = str(path) + '.tmp'
+    header = True
+    with open(temp_path, 'w', newline='') as handle:
+        for chunk in chunks:
+            chunk.to_csv(handle, header=header, index=False, **to_csv_args)
+            header = False
+    os.replace(temp_path, path)
+    return path
+
+
+def sales_csv(path, rows, products=None, chunksize=1000000, seed=0):
+    return write_csv(path, sales_chunks(rows, products, chunksize, seed), date_format='%Y-%m-%d')
+
+
+def gl_csv(path, rows, chunksize=1000000, seed=0):
+    return write_csv(path, gl_chunks(rows, chunksize, seed))
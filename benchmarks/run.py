@@ -0,0 +1,242 @@
+# Timed and memory-profiled benchmark scenarios for the main GusPI paths.
+# Each scenario runs on seeded synthetic data from benchmarks/generators.py and writes one JSON line per
+# (scenario, size) with the best wall time and the tracemalloc peak, so runs can be compared across upgrades.
+#
+#   python -m benchmarks.run --sizes 10k 1m --output results.jsonl
+#   python -m benchmarks.run --sizes 10k 1m --compare baseline.jsonl --tolerance 1.25
+#
+# Generated csv files are kept in --data-dir and reused by later runs with the same size and seed.
+# supy_lists and supy_forecast hold the parsed sales file in memory; supy_lists_chunked streams it
+# and is the one to use at 100m rows. supy_forecast times the Holt-Winters engine and
+# supy_forecast_prophet the Prophet engine, which is skipped when fbprophet is not installed.
+
+import argparse
+import contextlib
+import datetime
+import importlib.util
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from GusPI import display, finPy, statsPy, suPy  # noqa: E402
+from benchmarks import generators  # noqa: E402
+
+STATEMENT_YEARS = 10
+
+# Scenarios that need an optional package; they are skipped with a note when it is not installed
+OPTIONAL = {'supy_forecast_prophet': 'fbprophet'}
+
+
+def _sales_file(data_dir, rows, seed):
+    path = os.path.join(data_dir, 'sales-%d-%d.csv' % (rows, seed))
+    if not os.path.exists(path):
+        generators.sales_csv(path, rows, seed=seed)
+    return path
+
+
+def _gl_file(data_dir, rows, seed):
+    path = os.path.join(data_dir, 'gl-%d-%d.csv' % (rows, seed))
+    if not os.path.exists(path):
+        generators.gl_csv(path, rows, seed=seed)
+    return path
+
+
+def _supy_lists(dataset):
+    suPy.basicSafetyStockList(dataset, 5, 7)
+    suPy.safetyStockwtServiceRateList(dataset, 0.95, 7)
+    suPy.cvList(dataset)
+    suPy.eoqList(dataset, 2000, 1000)
+    suPy.avgQtySoldList(dataset)
+
+
+def setup_supy_parse(rows, data_dir, seed):
+    path = _sales_file(data_dir, rows, seed)
+    return lambda: suPy.prep_dataframe(path)
+
+
+def setup_supy_lists(rows, data_dir, seed):
+    dataset = suPy.SalesDataset.from_file(_sales_file(data_dir, rows, seed))
+    return lambda: _supy_lists(dataset)
+
+
+def setup_supy_lists_chunked(rows, data_dir, seed):
+    path = _sales_file(data_dir, rows, seed)
+    return lambda: suPy.productStatistics(path, chunksize=1000000)
+
+
+def setup_supy_forecast(rows, data_dir, seed):
+    dataset = suPy.SalesDataset.from_file(_sales_file(data_dir, rows, seed))
+    return lambda: suPy.forecastBatch(dataset, 'all', 'sales', 12, engine='holtwinters')
+
+
+def setup_supy_forecast_prophet(rows, data_dir, seed):
+    # One Prophet model per product over the process pool, as forecastBatch runs it by default
+    if importlib.util.find_spec(OPTIONAL['supy_forecast_prophet']) is None:
+        return None
+    dataset = suPy.SalesDataset.from_file(_sales_file(data_dir, rows, seed))
+    return lambda: suPy.forecastBatch(dataset, 'all', 'sales', 12, engine='prophet')
+
+
+def setup_benford(rows, data_dir, seed):
+    values = pd.read_csv(_gl_file(data_dir, rows, seed), usecols=['TotalAmount'])['TotalAmount'].values
+    return lambda: statsPy.process_benfordlaw(values, verbose=0)
+
+
+def _by_symbol_frames(companies, seed):
+    income, balance = generators.statement_panels(companies, STATEMENT_YEARS, seed)
+    _use_statement_panels(income, balance)
+    tickers = income.index.get_level_values(0).unique()
+    frames = [(finPy.get_annual_finData_by_symbol('balancesheet', ticker, 'us'),
+               finPy.get_annual_finData_by_symbol('income', ticker, 'us')) for ticker in tickers]
+    return frames
+
+
+def _use_statement_panels(income, balance):
+    # Serve the synthetic panels where finPy would load the SimFin bulk files, so no download is needed
+    panels = {'income': income, 'balance': balance}
+    finPy._load_simfin = lambda dataset, variant, country, columns=None: panels[dataset]
+    finPy.clear_market_store()
+
+
+def setup_calculate_metrics(rows, data_dir, seed):
+    frames = _by_symbol_frames(max(1, rows // STATEMENT_YEARS), seed)
+    return lambda: [finPy.calculateMetrics(balance, income) for balance, income in frames]
+
+
+def setup_calculate_ratio_mass(rows, data_dir, seed):
+    income, balance = generators.statement_panels(max(1, rows // STATEMENT_YEARS), STATEMENT_YEARS, seed)
+    _use_statement_panels(income, balance)
+    tickers = list(income.index.get_level_values(0).unique())
+    return lambda: finPy.calculate_ratio_mass(tickers)
+
+
+def setup_statement_ndjson(rows, data_dir, seed):
+    income, balance = generators.statement_panels(max(1, rows // STATEMENT_YEARS), STATEMENT_YEARS, seed)
+    _use_statement_panels(income, balance)
+    return lambda: finPy.write_statement_ndjson(os.devnull, 'income')
+
+
+SCENARIOS = {
+    'supy_parse': setup_supy_parse,
+    'supy_lists': setup_supy_lists,
+    'supy_lists_chunked': setup_supy_lists_chunked,
+    'supy_forecast': setup_supy_forecast,
+    'supy_forecast_prophet': setup_supy_forecast_prophet,
+    'process_benfordlaw': setup_benford,
+    'calculate_metrics': setup_calculate_metrics,
+    'calculate_ratio_mass': setup_calculate_ratio_mass,
+    'statement_ndjson': setup_statement_ndjson,
+}
+
+
+def measure(run, repeat):
+    # One untimed warm-up run so lazy imports are not counted, the best wall time over repeat runs,
+    # then one more run under tracemalloc for the peak allocation
+    run()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'pandas': pd.__version__,
+            'numpy': np.__version__, 'machine': platform.machine()}
+
+
+def compare(results, baseline_path, tolerance):
+    # Regressions against a previous results file, matched on scenario and rows
+    baseline = {}
+    with open(baseline_path) as handle:
+        for line in handle:
+            if line.strip():
+                record = json.loads(line)
+                baseline[(record['scenario'], record['rows'])] = record
+    regressions = []
+    for record in results:
+        previous = baseline.get((record['scenario'], record['rows']))
+        if previous is None:
+            continue
+        for key in ('seconds', 'peak_bytes'):
+            if previous[key] and record[key] > previous[key] * tolerance:
+                regressions.append('%s rows=%d %s: %.4g -> %.4g' % (record['scenario'], record['rows'], key,
+                                                                    previous[key], record[key]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=sorted(SCENARIOS))
+    parser.add_argument('--sizes', nargs='+', choices=list(generators.SIZES), default=['10k'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'guspi_bench'))
+    parser.add_argument('--output', help='append the JSON lines to this file instead of printing them')
+    parser.add_argument('--compare', help='results file of an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=1.25)
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    display.set_headless()
+    env = environment()
+    timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='guspi_bench_out_')
+    cwd = os.getcwd()
+    # The list functions write their csv files to the working directory and print their tables
+    os.chdir(work_dir)
+    try:
+        for size in args.sizes:
+            rows = generators.SIZES[size]
+            for name in args.scenarios:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    run = SCENARIOS[name](rows, args.data_dir, args.seed)
+                    if run is not None:
+                        seconds, peak = measure(run, args.repeat)
+                if run is None:
+                    print('%s %s: skipped, %s is not installed' % (name, size, OPTIONAL[name]), file=sys.stderr)
+                    continue
+                record = dict(scenario=name, size=size, rows=rows, seconds=round(seconds, 6), peak_bytes=peak,
+                              repeat=args.repeat, seed=args.seed, timestamp=timestamp, **env)
+                results.append(record)
+                line = json.dumps(record)
+                if args.output:
+                    with open(args.output, 'a') as handle:
+                        handle.write(line + '\n')
+                    print('%-22s %-5s %10.3fs %10.1f MB' % (name, size, seconds, peak / 2 ** 20))
+                else:
+                    print(line)
+    finally:
+        os.chdir(cwd)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for regression in regressions:
+            print('regression: ' + regression)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()